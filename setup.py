@@ -43,6 +43,7 @@ setup(name='z3c.saconfig',
       python_requires='>=3.9',
       install_requires=[
           'setuptools',
+          'SQLAlchemy>=2.0',
           'zope.sqlalchemy>=0.5',
           'zope.interface',
           'zope.component',
@@ -55,6 +56,12 @@ setup(name='z3c.saconfig',
       # -*- Entry points: -*-
       """,
       extras_require=dict(
-          test=['zope.testing'],
+          asyncio=['sqlalchemy[asyncio]'],
+          greenlet=['greenlet'],
+          test=[
+              'zope.testing',
+              'sqlalchemy[asyncio]',
+              'aiosqlite',
+          ],
       ),
       )
@@ -1,8 +1,24 @@
-from z3c.saconfig.scopedsession import Session
-from z3c.saconfig.scopedsession import named_scoped_session
-from z3c.saconfig.utility import EngineFactory
-from z3c.saconfig.utility import GloballyScopedSession
-from z3c.saconfig.utility import SiteScopedSession
+"""
+The public names are imported on first use, so that importing
+z3c.saconfig doesn't import SQLAlchemy for processes that never use it.
+"""
+import importlib
+
+
+_MODULES = {
+    'Session': 'z3c.saconfig.scopedsession',
+    'named_scoped_session': 'z3c.saconfig.scopedsession',
+    'named_async_scoped_session': 'z3c.saconfig.scopedsession',
+    'GloballyScopedSession': 'z3c.saconfig.utility',
+    'SiteScopedSession': 'z3c.saconfig.utility',
+    'EngineFactory': 'z3c.saconfig.utility',
+    'RoutingEngineFactory': 'z3c.saconfig.utility',
+    'FailoverEngineFactory': 'z3c.saconfig.utility',
+    'TenantEngineFactory': 'z3c.saconfig.utility',
+    'TenantScopedSession': 'z3c.saconfig.utility',
+    'AsyncScopedSession': 'z3c.saconfig.utility',
+    'AsyncEngineFactory': 'z3c.saconfig.utility',
+}
 
 
 __all__ = [
@@ -11,4 +27,26 @@ __all__ = [
     'GloballyScopedSession',
     'SiteScopedSession',
     'EngineFactory',
+    'RoutingEngineFactory',
+    'FailoverEngineFactory',
+    'TenantEngineFactory',
+    'TenantScopedSession',
+    'named_async_scoped_session',
+    'AsyncScopedSession',
+    'AsyncEngineFactory',
 ]
+
+
+def __getattr__(name):
+    try:
+        module = _MODULES[name]
+    except KeyError:
+        raise AttributeError(
+            "module %r has no attribute %r" % (__name__, name)) from None
+    value = getattr(importlib.import_module(module), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,231 @@
+"""
+Benchmarks for the per-request hot paths of z3c.saconfig.
+
+Run with::
+
+  python -m z3c.saconfig.benchmark [--json FILE] [--compare FILE]
+
+Each benchmark reports the best time per call out of several runs, using
+an in-memory SQLite database. ``--json`` writes the results to a file,
+``--compare`` compares them to such a file from an earlier run and exits
+with an error if a benchmark got slower than ``--tolerance`` percent.
+
+Nothing in here is used by the package itself.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import threading
+import timeit
+
+import sqlalchemy
+import transaction
+from zope import component
+
+from z3c.saconfig.interfaces import IEngineFactory
+from z3c.saconfig.interfaces import IScopedSession
+from z3c.saconfig.lookup import get_utility
+from z3c.saconfig.scopedsession import Session
+from z3c.saconfig.scopedsession import named_scoped_session
+from z3c.saconfig.scopedsession import scopefunc
+from z3c.saconfig.utility import EngineFactory
+from z3c.saconfig.utility import GloballyScopedSession
+from z3c.saconfig.utility import SiteScopedSession
+
+
+REPEAT = 5
+
+
+def setUp():
+    component.provideUtility(EngineFactory('sqlite://'),
+                             provides=IEngineFactory)
+    component.provideUtility(GloballyScopedSession(),
+                             provides=IScopedSession)
+
+
+def _per_call(func, number):
+    best = min(timeit.repeat(func, number=number, repeat=REPEAT))
+    return best / number
+
+
+def bench_lookup(number=100000):
+    """Compare uncached and memoized utility lookups."""
+    return {
+        'getUtility(IScopedSession)': _per_call(
+            lambda: component.getUtility(IScopedSession), number),
+        'get_utility(IScopedSession)': _per_call(
+            lambda: get_utility(IScopedSession), number),
+        'scopefunc()': _per_call(scopefunc, number),
+    }
+
+
+def bench_session(number=100000):
+    """Get the session of the current thread through the proxies."""
+    Session()
+    named = named_scoped_session('')
+    results = {
+        'Session()': _per_call(Session, number),
+        'Session.info': _per_call(lambda: Session.info, number),
+        "named_scoped_session('')": _per_call(
+            lambda: named_scoped_session(''), number),
+        "named_scoped_session('')()": _per_call(named, number),
+    }
+    Session.remove()
+    return results
+
+
+def bench_engine_factory(number=100000, misses=200):
+    """Get an engine from its factory, cached and uncached."""
+    factory = EngineFactory('sqlite://')
+    factory()
+
+    def miss():
+        factory.reset()
+        factory()
+
+    return {
+        'EngineFactory() hit': _per_call(factory, number),
+        'EngineFactory() miss': _per_call(miss, misses),
+    }
+
+
+class _BenchSiteScopedSession(SiteScopedSession):
+
+    site = 0
+
+    def siteScopeFunc(self):
+        return self.site
+
+
+def bench_sites(number=100000, sites=1000):
+    """Resolve the session of the current site among many sites."""
+    utility = _BenchSiteScopedSession()
+    component.provideUtility(utility, provides=IScopedSession,
+                             name='sites')
+    SitesSession = named_scoped_session('sites')
+    for site in range(sites):
+        utility.site = site
+        SitesSession()
+    turn = iter(range(sys.maxsize))
+
+    def session_of_next_site():
+        utility.site = next(turn) % sites
+        SitesSession()
+
+    results = {
+        'SiteScopedSession scope (%d sites)' % sites: _per_call(
+            session_of_next_site, number),
+    }
+    for site in range(sites):
+        utility.site = site
+        SitesSession.remove()
+    return results
+
+
+def bench_churn(threads=8, transactions=200):
+    """Create, use and remove sessions in many threads at once."""
+    # in-memory SQLite connections can't be shared between threads
+    directory = tempfile.mkdtemp()
+    url = 'sqlite:///' + os.path.join(directory, 'churn.db')
+    component.provideUtility(EngineFactory(url), provides=IEngineFactory,
+                             name='churn')
+    component.provideUtility(GloballyScopedSession(engine='churn'),
+                             provides=IScopedSession, name='churn')
+    ChurnSession = named_scoped_session('churn')
+    statement = sqlalchemy.select(1)
+
+    def work():
+        for i in range(transactions):
+            ChurnSession().execute(statement)
+            transaction.commit()
+            ChurnSession.remove()
+
+    def run():
+        workers = [threading.Thread(target=work) for i in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+    total = threads * transactions
+    try:
+        best = min(timeit.repeat(run, number=1, repeat=REPEAT))
+    finally:
+        get_utility(IEngineFactory, 'churn').reset()
+        shutil.rmtree(directory)
+    return {
+        'session churn (%d threads)' % threads: best / total,
+    }
+
+
+BENCHMARKS = (
+    bench_lookup,
+    bench_session,
+    bench_engine_factory,
+    bench_sites,
+    bench_churn,
+)
+
+
+def run():
+    setUp()
+    results = {}
+    for benchmark in BENCHMARKS:
+        results.update(benchmark())
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Compare results to a baseline, return the names that got slower.
+    """
+    slower = []
+    for name, seconds in sorted(results.items()):
+        before = baseline.get(name)
+        if not before:
+            continue
+        change = (seconds - before) / before * 100
+        if change > tolerance:
+            slower.append(name)
+        sys.stdout.write('%-45s %+7.1f%%\n' % (name, change))
+    return slower
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the hot paths of z3c.saconfig.")
+    parser.add_argument('--json', help="write the results to this file")
+    parser.add_argument('--compare', help="compare to results in this file")
+    parser.add_argument('--tolerance', type=float, default=10.0,
+                        help="percentage a benchmark may get slower "
+                             "(default: 10)")
+    options = parser.parse_args(argv)
+
+    results = run()
+    width = max(len(name) for name in results)
+    for name, seconds in results.items():
+        line = '%s  %10.1f ns\n' % (name.ljust(width), seconds * 1e9)
+        sys.stdout.write(line)
+
+    if options.json:
+        with open(options.json, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'sqlalchemy': sqlalchemy.__version__,
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)['results']
+        sys.stdout.write('\nCompared to %s:\n' % options.compare)
+        if compare(results, baseline, options.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,169 @@
+"""
+A budget of connections shared by the engines of a process.
+
+Every engine factory has its own pool, so a process with many engines
+can check out many more connections at once than the database allows.
+The engines created by engine factories after the budget is limited with
+``z3c.saconfig.utility.configure_connection_budget`` (or the
+``<db:connectionBudget>`` directive) take a connection of the budget for
+every checkout, and give it back on checkin. Once all are in use,
+checkouts wait for one, first come first served.
+"""
+import collections
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError
+from sqlalchemy.pool import SingletonThreadPool
+from sqlalchemy.pool import StaticPool
+
+
+# marks connections that took a connection of the budget
+_BUDGETED = 'z3c.saconfig.budgeted'
+
+
+class ConnectionBudgetTimeout(TimeoutError):
+    """No connection of the connection budget became free in time."""
+
+
+class ConnectionBudget:
+    """Limits the connections checked out of all engines together.
+
+    Checkouts beyond ``limit`` wait in turn for a connection to be checked
+    in, for at most ``timeout`` seconds, or as long as it takes if that
+    is None, and then raise ConnectionBudgetTimeout. No limit means no
+    waiting.
+    """
+
+    def __init__(self, limit=None, timeout=None):
+        self._lock = threading.Lock()
+        # a lock per waiting checkout, released to hand a connection over
+        self._waiters = collections.deque()
+        self.in_use = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.timeouts = 0
+        self.configure(limit, timeout)
+
+    def configure(self, limit=None, timeout=None):
+        self._lock.acquire()
+        try:
+            self.limit = limit
+            self.timeout = timeout
+            # a higher limit lets waiting checkouts in
+            while self._waiters and (limit is None or self.in_use < limit):
+                self.in_use += 1
+                self._waiters.popleft().release()
+        finally:
+            self._lock.release()
+
+    def acquire(self):
+        """Take a connection of the budget, waiting for one if needed.
+        """
+        self._lock.acquire()
+        try:
+            self.checkouts += 1
+            if not self._waiters and (
+                    self.limit is None or self.in_use < self.limit):
+                self.in_use += 1
+                return
+            waiter = threading.Lock()
+            waiter.acquire()
+            self._waiters.append(waiter)
+            timeout = self.timeout
+            self.waits += 1
+        finally:
+            self._lock.release()
+        start = time.perf_counter()
+        acquired = waiter.acquire(timeout=-1 if timeout is None else timeout)
+        self._lock.acquire()
+        try:
+            self.wait_time += time.perf_counter() - start
+            if not acquired:
+                try:
+                    self._waiters.remove(waiter)
+                except ValueError:
+                    # handed over after the timeout, before the lock
+                    acquired = True
+                else:
+                    self.timeouts += 1
+        finally:
+            self._lock.release()
+        if not acquired:
+            raise ConnectionBudgetTimeout(
+                "Connection budget of %s connections used up, timed out "
+                "after %s seconds" % (self.limit, timeout))
+
+    def release(self):
+        """Give a connection back to the budget.
+        """
+        self._lock.acquire()
+        try:
+            if self._waiters and (
+                    self.limit is None or self.in_use <= self.limit):
+                # hand it over to the first waiting checkout
+                self._waiters.popleft().release()
+            else:
+                self.in_use -= 1
+        finally:
+            self._lock.release()
+
+    def attach(self, engine):
+        """Make the checkouts of an engine take connections of the budget.
+
+        Engines whose pool shares connections between checkouts, like
+        those of SQLite in-memory databases, are left alone.
+        """
+        if isinstance(engine.pool, (SingletonThreadPool, StaticPool)):
+            return
+        event.listen(engine, 'checkin', self._checkedIn)
+        event.listen(engine, 'detach', self._checkedIn)
+        event.listen(engine, 'engine_disposed', self._disposed)
+        self._wrapPool(engine.pool)
+
+    def _wrapPool(self, pool):
+        # there is no pool event before a checkout, so wrap it
+        connect = pool.connect
+
+        def budgeted_connect():
+            self.acquire()
+            try:
+                connection = connect()
+            except BaseException:
+                self.release()
+                raise
+            connection.record_info[_BUDGETED] = True
+            return connection
+
+        pool.connect = budgeted_connect
+
+    def _disposed(self, engine):
+        # disposing an engine replaces its pool
+        self._wrapPool(engine.pool)
+
+    def _checkedIn(self, dbapi_connection, connection_record):
+        if connection_record.record_info.pop(_BUDGETED, False):
+            self.release()
+
+    def forked(self):
+        """Forget the connections of the parent process.
+        """
+        # another thread may have held the lock when the process forked
+        self._lock = threading.Lock()
+        self._waiters = collections.deque()
+        self.in_use = 0
+
+    def stats(self):
+        """Return a dictionary with the state and counters of the budget.
+        """
+        return {
+            'limit': self.limit,
+            'in_use': self.in_use,
+            'waiting': len(self._waiters),
+            'checkouts': self.checkouts,
+            'waits': self.waits,
+            'wait_time': self.wait_time,
+            'timeouts': self.timeouts,
+        }
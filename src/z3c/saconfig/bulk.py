@@ -0,0 +1,147 @@
+"""
+Batched inserts and upserts for scoped sessions.
+
+``bulk_writer`` returns a ``BulkWriter`` for the session of a scoped
+session, for the current Zope transaction. It collects rows per mapped
+class and writes them with one executemany INSERT per batch, which
+SQLAlchemy turns into the fast paths of the dialect (multi-row VALUES
+with "insertmanyvalues", psycopg's fast executemany). What is left is
+written before the transaction commits; nothing is written if it aborts.
+
+Rows can come from a generator; no more than a batch is held in memory.
+"""
+import transaction
+from sqlalchemy import insert
+from sqlalchemy import inspect
+
+from z3c.saconfig.scopedsession import named_scoped_session
+
+
+class BulkWriter:
+    """Writes rows to the database in batches through a session.
+
+    Rows are dictionaries of attribute values of a mapped class. Rows
+    written in one batch should have the same keys.
+    """
+
+    def __init__(self, session, batch_size=1000):
+        self.session = session
+        self.batch_size = batch_size
+        self.written = 0
+        self._pending = {}
+
+    def insert(self, entity, rows):
+        """Insert rows, a dictionary or an iterable of them.
+        """
+        self._add((inspect(entity).mapper, None), rows)
+
+    def upsert(self, entity, rows, index_elements=None):
+        """Insert rows, updating those that exist already.
+
+        A row exists if it has the same values for ``index_elements``,
+        column names with a unique constraint; the primary key by
+        default. Supported for PostgreSQL, SQLite and MySQL; MySQL
+        ignores ``index_elements`` and checks every unique constraint.
+        Other databases raise ValueError, before any row is taken.
+        """
+        mapper = inspect(entity).mapper
+        dialect = _dialect(self.session, mapper)
+        if dialect not in UPSERT_DIALECTS:
+            raise ValueError("Upserts are not supported for %s" % dialect)
+        if index_elements is None:
+            index_elements = [column.name for column in mapper.primary_key]
+        self._add((mapper, tuple(index_elements)), rows)
+
+    def _add(self, key, rows):
+        if isinstance(rows, dict):
+            rows = [rows]
+        pending = self._pending.setdefault(key, [])
+        for row in rows:
+            pending.append(row)
+            if len(pending) >= self.batch_size:
+                self._write(key, pending)
+                pending = self._pending[key] = []
+
+    def flush(self):
+        """Write all rows that are not written yet.
+        """
+        for key, rows in list(self._pending.items()):
+            if rows:
+                self._pending[key] = []
+                self._write(key, rows)
+
+    def __len__(self):
+        """The number of rows that are not written yet."""
+        return sum(len(rows) for rows in self._pending.values())
+
+    def _write(self, key, rows):
+        mapper, index_elements = key
+        if index_elements is None:
+            statement = insert(mapper)
+        else:
+            statement = _upsert(self.session, mapper, index_elements, rows[0])
+        self.session.execute(statement, rows)
+        self.written += len(rows)
+
+
+UPSERT_DIALECTS = ('postgresql', 'sqlite', 'mysql', 'mariadb')
+
+
+def _dialect(session, mapper):
+    # a session with replicas picks the primary for an INSERT
+    return session.get_bind(
+        mapper, clause=insert(mapper)).dialect.name
+
+
+def _upsert(session, mapper, index_elements, row):
+    dialect = _dialect(session, mapper)
+    columns = [mapper.attrs[key].columns[0] for key in row
+               if mapper.attrs[key].columns[0].name not in index_elements]
+    if dialect in ('postgresql', 'sqlite'):
+        if dialect == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert as dialect_insert
+        else:
+            from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        statement = dialect_insert(mapper)
+        excluded = statement.excluded
+        if not columns:
+            return statement.on_conflict_do_nothing(
+                index_elements=index_elements)
+        return statement.on_conflict_do_update(
+            index_elements=index_elements,
+            set_={column.name: excluded[column.key] for column in columns})
+    else:
+        from sqlalchemy.dialects.mysql import insert as dialect_insert
+        statement = dialect_insert(mapper)
+        inserted = statement.inserted
+        # updating a key column to itself makes a row without other
+        # columns a no-op
+        columns = columns or [mapper.primary_key[0]]
+        return statement.on_duplicate_key_update(
+            {column.name: inserted[column.key] for column in columns})
+
+
+def bulk_writer(name='', batch_size=1000):
+    """Get the BulkWriter of a scoped session for the current transaction.
+
+    ``name`` is the name of the scoped session, as for
+    ``named_scoped_session``. ``batch_size`` applies when the writer is
+    created by the first call in a transaction.
+    """
+    session = named_scoped_session(name)()
+    txn = transaction.get()
+    try:
+        writers = txn.data(BulkWriter)
+    except KeyError:
+        writers = {}
+        txn.set_data(BulkWriter, writers)
+        txn.addBeforeCommitHook(_flushWriters, (writers, ))
+    writer = writers.get(session)
+    if writer is None:
+        writer = writers[session] = BulkWriter(session, batch_size)
+    return writer
+
+
+def _flushWriters(writers):
+    for writer in writers.values():
+        writer.flush()
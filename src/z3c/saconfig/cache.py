@@ -0,0 +1,225 @@
+"""
+A process-wide cache of rows looked up by primary key.
+
+Pass ``cache_size`` and/or ``cache_ttl`` to GloballyScopedSession or
+SiteScopedSession (or set them on the ``<db:session>`` directive) to keep
+the column values of the objects their sessions load in an
+``IdentityCache``. ``Session.get`` then finds objects there that are not
+in the session yet, without a query, also in later transactions.
+
+Objects are cached per database, by engine URL and schema translation
+map, so that sites or tenants served by one utility with different
+engines or schemas don't get each other's rows.
+
+Objects changed by a session are dropped from the cache when the session
+commits, and classes changed with bulk updates or deletes entirely. The
+cache doesn't know about changes made otherwise, like those of other
+processes or of plain SQL statements; these go unnoticed until the
+objects expire, after ``cache_ttl`` seconds, DEFAULT_TTL by default.
+Column values are shared between sessions, so don't change mutable ones
+in place.
+"""
+import collections
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy import inspect
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+
+
+# marks session transactions that flushed, with what they changed
+_CHANGED = 'z3c.saconfig.cache.changed'
+
+# seconds objects are kept by the caches of scoped session utilities
+DEFAULT_TTL = 60.0
+
+
+class IdentityCache:
+    """Column values of mapped objects by database and identity key.
+
+    Keeps the ``maxsize`` most recently used objects, for at most ``ttl``
+    seconds if that is given.
+    """
+
+    def __init__(self, maxsize=1000, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def get(self, key):
+        """Get the class and column values of an object, or None.
+        """
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] <= time.monotonic():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+        finally:
+            self._lock.release()
+
+    def put(self, key, class_, values):
+        if self.ttl is None:
+            expires = float('inf')
+        else:
+            expires = time.monotonic() + self.ttl
+        self._lock.acquire()
+        try:
+            self._entries[key] = ((class_, values), expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        finally:
+            self._lock.release()
+
+    def invalidate(self, keys=(), classes=()):
+        """Drop objects by identity key, and all objects of some classes.
+        """
+        classes = tuple(classes)
+        self._lock.acquire()
+        try:
+            for key in keys:
+                self._entries.pop(key, None)
+            if classes:
+                for key, ((class_, values), expires) in list(
+                        self._entries.items()):
+                    if issubclass(class_, classes):
+                        del self._entries[key]
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        """Return a dictionary with the counters and size of the cache.
+        """
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+class CachingSession:
+    """A session mixin looking up objects in an IdentityCache.
+    """
+
+    identity_cache = None
+
+    def get(self, entity, ident, **kw):
+        if kw or _CHANGED in self.info:
+            # options, or changes the cache doesn't have yet
+            return super().get(entity, ident, **kw)
+        mapper = inspect(entity).mapper
+        key = mapper.identity_key_from_primary_key(
+            _primaryKey(mapper, ident))
+        if key in self.identity_map:
+            return super().get(entity, ident, **kw)
+        cached = self.identity_cache.get((_database(self, mapper), key))
+        if cached is None:
+            return super().get(entity, ident, **kw)
+        class_, values = cached
+        instance = inspect(class_).class_manager.new_instance()
+        for name, value in values.items():
+            set_committed_value(instance, name, value)
+        make_transient_to_detached(instance)
+        self.add(instance)
+        return instance
+
+
+def _primaryKey(mapper, ident):
+    if isinstance(ident, dict):
+        return [ident[mapper.get_property_by_column(column).key]
+                for column in mapper.primary_key]
+    if isinstance(ident, (tuple, list)):
+        return list(ident)
+    return [ident]
+
+
+def _database(session, mapper):
+    """Identify the database and schemas a session uses for a mapper.
+    """
+    bind = session.bind
+    if bind is None:
+        bind = session.get_bind(mapper)
+    # a Connection has the execution options of its engine and its own
+    translate = bind.get_execution_options().get('schema_translate_map')
+    if translate:
+        translate = frozenset(translate.items())
+    return (bind.engine.url, translate)
+
+
+def caching_session_class(class_, cache):
+    """Make a session class using a cache, based on a session class.
+    """
+    session_class = type(class_.__name__, (CachingSession, class_),
+                         {'identity_cache': cache})
+    event.listen(session_class, 'loaded_as_persistent', _loaded)
+    event.listen(session_class, 'after_flush', _flushed)
+    event.listen(session_class, 'do_orm_execute', _executed)
+    event.listen(session_class, 'after_commit', _committed)
+    event.listen(session_class, 'after_transaction_end', _ended)
+    return session_class
+
+
+def _loaded(session, instance):
+    if _CHANGED in session.info:
+        # the row may have changes that are not committed
+        return
+    state = inspect(instance)
+    values = {}
+    for prop in state.mapper.column_attrs:
+        if prop.key not in state.dict:
+            # deferred or expired, don't cache part of the row
+            return
+        values[prop.key] = state.dict[prop.key]
+    session.identity_cache.put(
+        (_database(session, state.mapper), state.key), state.class_, values)
+
+
+def _changes(session):
+    return session.info.setdefault(_CHANGED, (set(), set()))
+
+
+def _flushed(session, flush_context):
+    keys = _changes(session)[0]
+    # these still show what was flushed
+    for instance in list(session.dirty) + list(session.deleted):
+        state = inspect(instance)
+        keys.add((_database(session, state.mapper), state.key))
+
+
+def _executed(orm_execute_state):
+    if orm_execute_state.is_update or orm_execute_state.is_delete:
+        mapper = orm_execute_state.bind_mapper
+        if mapper is not None:
+            _changes(orm_execute_state.session)[1].add(mapper.class_)
+
+
+def _committed(session):
+    changes = session.info.pop(_CHANGED, None)
+    if changes is not None:
+        session.identity_cache.invalidate(*changes)
+
+
+def _ended(session, session_transaction):
+    if session_transaction.parent is None:
+        session.info.pop(_CHANGED, None)
@@ -0,0 +1,186 @@
+"""
+Request deadlines for the statements of sessions.
+
+Pass ``deadlines=True`` to GloballyScopedSession or SiteScopedSession (or
+set ``deadlines`` on the ``<db:session>`` directive) to make the statements
+of their sessions respect the deadline of the current request. The
+deadline is set with ``set_deadline``, or the ``deadline`` context
+manager, usually when a request starts. It is kept in a context variable,
+so it applies to the thread or task handling the request.
+
+Before every statement, the time left is turned into a timeout of the
+database, so that it cancels statements still running at the deadline:
+
+- PostgreSQL: ``SET LOCAL statement_timeout``
+- MySQL: ``SET SESSION max_execution_time`` (MariaDB: ``max_statement_time``)
+- SQLite: a progress handler of the connection
+
+Statements started after the deadline, and statements cancelled by the
+database because of it, raise DeadlineExceeded. With other databases only
+the former is done. The timeout is removed again before other statements
+on the database connection, and when it is returned to the pool.
+
+Sessions of utilities with deadlines can't share connections with other
+sessions, see z3c.saconfig.shared.
+"""
+import contextlib
+import contextvars
+import math
+import time
+
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError
+
+
+# the time.monotonic() of the deadline of the current request
+_DEADLINE = contextvars.ContextVar('z3c.saconfig.deadline', default=None)
+
+# execution option of connections of sessions that respect deadlines
+_DEADLINES = 'z3c_saconfig_deadlines'
+
+# connection info key of the timeout set on a database connection
+_TIMEOUT = 'z3c.saconfig.timeout'
+
+# SQLite virtual machine instructions between deadline checks
+SQLITE_CHECK_INTERVAL = 1000
+
+
+class DeadlineExceeded(TimeoutError):
+    """A statement did not finish before the deadline of the request."""
+
+
+def set_deadline(seconds):
+    """Set the deadline of the current request to ``seconds`` from now.
+
+    None removes the deadline. Returns a token for ``reset_deadline``.
+    """
+    if seconds is None:
+        return _DEADLINE.set(None)
+    return _DEADLINE.set(time.monotonic() + seconds)
+
+
+def reset_deadline(token):
+    """Restore the deadline from before ``set_deadline`` returned token.
+    """
+    _DEADLINE.reset(token)
+
+
+@contextlib.contextmanager
+def deadline(seconds):
+    """Set the deadline for the statements of a block of code.
+    """
+    token = set_deadline(seconds)
+    try:
+        yield
+    finally:
+        reset_deadline(token)
+
+
+def remaining():
+    """Return the seconds left until the deadline, or None without one.
+    """
+    when = _DEADLINE.get()
+    if when is None:
+        return None
+    return max(when - time.monotonic(), 0.0)
+
+
+def enforce_deadlines(session):
+    """Make the statements of a session respect request deadlines.
+
+    ``session`` may also be a sessionmaker, for all sessions it creates.
+    """
+    event.listen(session, 'after_begin', _after_begin)
+
+
+def _after_begin(session, session_transaction, connection):
+    # a session transaction gets a new Connection, so this doesn't leak
+    # into other uses of the engine; utilities with deadlines don't share
+    # connections
+    connection.execution_options(**{_DEADLINES: True})
+    engine = connection.engine
+    if not event.contains(engine, 'before_cursor_execute', _before):
+        event.listen(engine, 'before_cursor_execute', _before)
+        event.listen(engine, 'handle_error', _handle_error)
+        event.listen(engine, 'checkin', _checkin)
+
+
+def _before(conn, cursor, statement, parameters, context, executemany):
+    when = None
+    if context is not None and context.execution_options.get(_DEADLINES):
+        when = _DEADLINE.get()
+    info = conn.info
+    if when is None:
+        if info.get(_TIMEOUT) is not None:
+            # set for another statement on this database connection
+            _set_timeout(info.pop(_TIMEOUT), conn.connection.dbapi_connection,
+                         None)
+        return
+    left = when - time.monotonic()
+    if left <= 0:
+        raise DeadlineExceeded(
+            "Deadline passed %.3f seconds before the statement: %s"
+            % (-left, statement))
+    _set_timeout(conn.dialect, conn.connection.dbapi_connection, when)
+    info[_TIMEOUT] = conn.dialect
+
+
+def _checkin(dbapi_connection, connection_record):
+    # don't hand a timeout on to the next user of the connection
+    dialect = connection_record.info.pop(_TIMEOUT, None)
+    if dialect is None or dbapi_connection is None:
+        return
+    if dialect.name == 'postgresql':
+        # it ended with the transaction, which the pool rolled back
+        return
+    _set_timeout(dialect, dbapi_connection, None)
+
+
+def _set_timeout(dialect, dbapi_connection, when):
+    """Set the timeout of a database connection, None for no timeout.
+    """
+    if when is not None:
+        # whole milliseconds, not before the deadline
+        ms = max(math.ceil((when - time.monotonic()) * 1000), 1)
+    if dialect.name == 'postgresql':
+        # until the end of the database transaction
+        statement = ("SET LOCAL statement_timeout = %s"
+                     % ('DEFAULT' if when is None else ms))
+    elif dialect.name == 'mysql':
+        if getattr(dialect, 'is_mariadb', False):
+            statement = "SET SESSION max_statement_time = %s" % (
+                'DEFAULT' if when is None else '%.3f' % (ms / 1000.0))
+        else:
+            # MySQL only times out SELECT statements
+            statement = ("SET SESSION max_execution_time = %s"
+                         % ('DEFAULT' if when is None else ms))
+    elif dialect.name == 'sqlite':
+        if when is None:
+            dbapi_connection.set_progress_handler(None, 0)
+        else:
+            dbapi_connection.set_progress_handler(
+                lambda: time.monotonic() > when, SQLITE_CHECK_INTERVAL)
+        return
+    else:
+        return
+    # not with the cursor of the statement, which may be a server side
+    # cursor that can only execute a query
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute(statement)
+    finally:
+        cursor.close()
+
+
+def _handle_error(context):
+    execution_context = context.execution_context
+    if (execution_context is None or isinstance(
+            context.original_exception, DeadlineExceeded)
+            or not execution_context.execution_options.get(_DEADLINES)):
+        return
+    when = _DEADLINE.get()
+    if when is not None and time.monotonic() >= when:
+        # most likely cancelled by the timeout
+        raise DeadlineExceeded(
+            "Statement cancelled at the deadline: %s"
+            % context.statement) from context.original_exception
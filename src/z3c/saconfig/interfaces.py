@@ -14,7 +14,7 @@ class IScopedSession(Interface):
     def sessionFactory():
         """Create a SQLAlchemy session.
 
-        Typically you'd use sqlalchemy.orm.create_session to create
+        Typically you'd use a sqlalchemy.orm.sessionmaker to create
         the session here.
         """
 
@@ -63,6 +63,71 @@ class IEngineFactory(Interface):
         """
 
 
+class IRoutingEngineFactory(IEngineFactory):
+    """An engine factory that routes reads to replica databases.
+
+    Calling it returns the engine of the primary database, which is used
+    for flushes and data changing statements.
+    """
+
+    def replica():
+        """Get an engine for a read-only statement.
+
+        Returns the primary engine if no replicas are configured.
+        """
+
+
+class ITenantEngineFactory(IEngineFactory):
+    """An engine factory whose engine is shared by many tenants.
+
+    Tenants keep their tables in a schema of their own.
+    """
+
+    def tenant(schema):
+        """Get an engine for the tenant with the given schema.
+
+        It shares the pool of the factory's engine, and uses ``schema`` for
+        tables that have no schema set.
+        """
+
+
+class IAsyncEngineFactory(Interface):
+    """A utility that maintains an SQLAlchemy asyncio engine.
+
+    This is separate from IEngineFactory, so that lookups for ordinary
+    engines never return an asyncio one.
+    """
+
+    def __call__():
+        """Get the ``AsyncEngine``.
+
+        This creates the engine if this factory was not used before,
+        otherwise returns a cached version.
+        """
+
+    def configuration():
+        """Returns the engine configuration in the form of an args, kw tuple.
+        """
+
+    def reset():
+        """Reset the cached engine (if any).
+        """
+
+
+class IAsyncScopedSession(Interface):
+    """A utility that plugs into SQLAlchemy's asyncio scoped sessions.
+    """
+    def sessionFactory():
+        """Create a ``sqlalchemy.ext.asyncio.AsyncSession``.
+        """
+
+    def scopeFunc():
+        """Determine the scope of the session.
+
+        Typically this is the current asyncio task.
+        """
+
+
 class IEngineCreatedEvent(Interface):
     """An SQLAlchemy engine has been created.
 
@@ -85,3 +150,48 @@ class EngineCreatedEvent:
         self.engine = engine
         self.engine_args = engine_args
         self.engine_kw = engine_kw
+
+
+class IEngineWarmedUpEvent(Interface):
+    """An engine factory has warmed up its engine.
+
+    See ``EngineFactory.warmup``.
+    """
+    engine = Attribute("The engine that was warmed up.")
+
+    connections = Attribute("The number of pool connections that were "
+                            "opened ahead of use.")
+
+
+@implementer(IEngineWarmedUpEvent)
+class EngineWarmedUpEvent:
+
+    def __init__(self, engine, connections):
+        self.engine = engine
+        self.connections = connections
+
+
+class ICircuitStateChangedEvent(Interface):
+    """The circuit breaker of a FailoverEngineFactory changed state.
+
+    It is 'closed' while a database can be used, and 'open' while none
+    can. The factory fails over to another database by opening and
+    closing again.
+    """
+    factory = Attribute("The engine factory.")
+
+    old_state = Attribute("The previous state, 'closed' or 'open'.")
+
+    state = Attribute("The new state.")
+
+    url = Attribute("The URL of the database that is, or was, in use.")
+
+
+@implementer(ICircuitStateChangedEvent)
+class CircuitStateChangedEvent:
+
+    def __init__(self, factory, old_state, state, url):
+        self.factory = factory
+        self.old_state = old_state
+        self.state = state
+        self.url = url
@@ -0,0 +1,68 @@
+"""
+Memoized utility lookups for the per-call session and engine paths.
+
+``z3c.saconfig.Session`` resolves its ``IScopedSession`` utility on every
+proxied attribute access, and session creation resolves an
+``IEngineFactory`` as well. Both are plain ``getUtility`` calls that walk
+the adapter registry of the active site manager each time. This module
+caches the results per utility registry.
+
+A cache is keyed on the utility registry of the active site manager and
+remembers the registry's generation. ``zope.interface`` bumps the
+generation of a registry (and of all registries that use it as a base)
+whenever a utility is registered or unregistered, so stale entries are
+never returned.
+"""
+from zope import component
+
+
+# bumped by invalidate() to drop the caches of all registries at once
+_epoch = 0
+
+
+def get_utility(interface, name=''):
+    """Look up a utility like ``zope.component.getUtility``, but memoized.
+
+    Raises ``ComponentLookupError`` if the utility cannot be found;
+    failed lookups are not cached.
+    """
+    sitemanager = component.getSiteManager()
+    registry = sitemanager.utilities
+    # read the generation before doing the lookup, so that a registration
+    # happening concurrently can only make us store into an outdated cache
+    generation = (getattr(registry, '_generation', None), _epoch)
+    try:
+        cached_generation, utilities = registry._v_z3c_saconfig_cache
+    except AttributeError:
+        cached_generation = utilities = None
+    if cached_generation != generation:
+        if generation[0] is None:
+            return sitemanager.getUtility(interface, name)
+        utilities = {}
+        # ``_v_`` attributes are not stored for persistent registries
+        registry._v_z3c_saconfig_cache = (generation, utilities)
+    key = (interface, name)
+    try:
+        return utilities[key]
+    except KeyError:
+        pass
+    utility = utilities[key] = sitemanager.getUtility(interface, name)
+    return utility
+
+
+def invalidate(*args):
+    """Drop all memoized lookups.
+
+    This can be used as a handler for (un)registration events; it accepts
+    and ignores any arguments.
+    """
+    global _epoch
+    _epoch += 1
+
+
+try:
+    from zope.testing.cleanup import addCleanUp
+except ImportError:  # pragma: no cover
+    pass
+else:
+    addCleanUp(invalidate)
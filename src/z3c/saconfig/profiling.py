@@ -0,0 +1,127 @@
+"""
+Statement timing for sessions created by the IScopedSession utilities.
+
+Pass ``profile=True`` to GloballyScopedSession or SiteScopedSession (or set
+``profile`` on the ``<db:session>`` directive) to time every statement
+executed by their sessions. The timings of a Zope transaction are collected
+in a ``QueryProfile``, which ``transaction_profile`` returns.
+
+With a ``slow_threshold`` in seconds, statements that take longer than that
+are logged with their parameters to the ``z3c.saconfig.profiling`` logger.
+"""
+import logging
+import time
+
+import transaction
+from sqlalchemy import event
+
+
+logger = logging.getLogger('z3c.saconfig.profiling')
+
+# execution option carrying the profile of a session transaction
+_PROFILE = 'z3c_saconfig_profile'
+
+
+class QueryProfile:
+    """The statements executed during one Zope transaction.
+    """
+
+    def __init__(self):
+        self.durations = []
+        self.slow = 0
+
+    def record(self, duration, slow=False):
+        self.durations.append(duration)
+        if slow:
+            self.slow += 1
+
+    @property
+    def count(self):
+        return len(self.durations)
+
+    @property
+    def total(self):
+        return sum(self.durations)
+
+    def percentile(self, percent):
+        """Return the duration below which ``percent`` of statements fall.
+        """
+        if not self.durations:
+            return 0.0
+        durations = sorted(self.durations)
+        index = max(int(round(percent / 100.0 * len(durations))) - 1, 0)
+        return durations[min(index, len(durations) - 1)]
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+            'max': max(self.durations, default=0.0),
+            'slow': self.slow,
+        }
+
+
+def transaction_profile(txn=None):
+    """Get the QueryProfile of a Zope transaction, the current by default.
+
+    Returns None if no profiled session did anything in the transaction.
+    """
+    if txn is None:
+        txn = transaction.get()
+    try:
+        return txn.data(QueryProfile)
+    except KeyError:
+        return None
+
+
+def profile_session(session, slow_threshold=None):
+    """Time the statements executed by a session.
+
+    ``session`` may also be a sessionmaker, to time the statements of all
+    sessions it creates. Sessions sharing its connections (see
+    z3c.saconfig.shared) are timed along with it.
+    """
+    def after_begin(session, session_transaction, connection):
+        txn = transaction.get()
+        profile = transaction_profile(txn)
+        if profile is None:
+            profile = QueryProfile()
+            txn.set_data(QueryProfile, profile)
+        # this stays on the Connection until it is closed: with the
+        # session transaction, or with the Zope transaction when the
+        # connection is shared, which then profiles the statements of all
+        # sessions sharing it in the same profile
+        connection.execution_options(
+            **{_PROFILE: (profile, slow_threshold)})
+        _instrument(connection.engine)
+
+    event.listen(session, 'after_begin', after_begin)
+
+
+def _instrument(engine):
+    if not event.contains(engine, 'before_cursor_execute', _before):
+        event.listen(engine, 'before_cursor_execute', _before)
+        event.listen(engine, 'after_cursor_execute', _after)
+
+
+def _before(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context._z3c_saconfig_start = time.perf_counter()
+
+
+def _after(conn, cursor, statement, parameters, context, executemany):
+    if context is None:
+        return
+    options = context.execution_options.get(_PROFILE)
+    if options is None:
+        return
+    duration = time.perf_counter() - context._z3c_saconfig_start
+    profile, slow_threshold = options
+    slow = slow_threshold is not None and duration >= slow_threshold
+    if slow:
+        logger.warning("Slow statement (%.3fs): %s; parameters: %r",
+                       duration, statement, parameters)
+    profile.record(duration, slow)
@@ -0,0 +1,356 @@
+"""
+The process-wide stores of engines created by engine factories and of the
+sessions of scoped sessions.
+"""
+import collections
+import logging
+import threading
+import time
+import weakref
+
+from sqlalchemy import event
+from sqlalchemy.util import ScopedRegistry
+
+from z3c.saconfig.scopes import THREAD
+
+
+logger = logging.getLogger('z3c.saconfig')
+
+
+def checked_out(engine):
+    """Return the number of connections checked out of an engine's pool.
+    """
+    # asyncio engines keep their pool on the synchronous engine
+    engine = getattr(engine, 'sync_engine', engine)
+    try:
+        return engine.pool.checkedout()
+    except AttributeError:
+        # not all pool classes keep track of this
+        return 0
+
+
+class EngineRegistry:
+    """Engines by the key of the engine factory that created them.
+
+    By default an engine is kept until its factory is reset. The registry
+    can be bounded: ``maxsize`` limits the number of engines, evicting the
+    least recently used ones, and ``idle_ttl`` evicts engines that have not
+    been asked for in that many seconds. Evicted engines, like replaced
+    and retired ones, are disposed as soon as none of their connections
+    are checked out, on the next lookup after the last one is returned.
+    The factory of an evicted engine creates a new one when it is called
+    again.
+
+    Lookups of known engines don't take a lock. The ``hits``, ``misses``
+    and ``evictions`` counters are not locked either, so they may be
+    slightly off under heavy concurrency.
+    """
+
+    def __init__(self, maxsize=None, idle_ttl=None):
+        self._engines = collections.OrderedDict()
+        self._lock = threading.Lock()
+        # engines that were evicted, replaced or retired but still had
+        # connections checked out
+        self._retired = []
+        self._next_sweep = 0
+        self._checkedIn = False
+        self.hits = self.misses = self.evictions = 0
+        self.configure(maxsize, idle_ttl)
+
+    def configure(self, maxsize=None, idle_ttl=None):
+        """Set the bounds of the registry; None means unbounded.
+        """
+        self.maxsize = maxsize
+        self.idle_ttl = idle_ttl
+        self._bounded = maxsize is not None or idle_ttl is not None
+        self.sweep()
+
+    def get(self, key):
+        """Get the engine for key, or None.
+        """
+        entry = self._engines.get(key)
+        if entry is None:
+            return None
+        self.hits += 1
+        if self._checkedIn:
+            # a retired engine may no longer be used, dispose of it
+            self.sweep()
+        if self._bounded:
+            entry[1] = now = time.monotonic()
+            try:
+                self._engines.move_to_end(key)
+            except KeyError:
+                # evicted in the meantime; the engine still works
+                pass
+            if now >= self._next_sweep:
+                self.sweep()
+        return entry[0]
+
+    def __contains__(self, key):
+        return key in self._engines
+
+    def __len__(self):
+        return len(self._engines)
+
+    def keys(self):
+        return list(self._engines)
+
+    def add(self, key, engine, dispose):
+        """Store a newly created engine.
+
+        ``dispose`` is called with the engine when it gets evicted.
+        """
+        self._lock.acquire()
+        try:
+            self.misses += 1
+            self._engines[key] = [engine, time.monotonic(), dispose]
+        finally:
+            self._lock.release()
+        self.sweep()
+
+    def replace(self, key, engine, dispose):
+        """Store a new engine for key in place of the current one.
+
+        Lookups get either engine, never none. The engine that is
+        replaced is disposed like an evicted one.
+        """
+        self._lock.acquire()
+        try:
+            old = self._engines.get(key)
+            self._engines[key] = [engine, time.monotonic(), dispose]
+            if old is not None:
+                self._retired.append((old[0], old[2]))
+        finally:
+            self._lock.release()
+        self.sweep()
+
+    def retire(self, key):
+        """Remove the engine for key, disposing it when it is not used.
+
+        Unlike ``pop``, the engine is disposed here, or as soon as the
+        connections that are checked out are returned. Returns the engine,
+        or None.
+        """
+        self._lock.acquire()
+        try:
+            entry = self._engines.pop(key, None)
+            if entry is not None:
+                self._retired.append((entry[0], entry[2]))
+        finally:
+            self._lock.release()
+        if entry is not None:
+            self.sweep()
+            return entry[0]
+
+    def pop(self, key):
+        """Remove the engine for key and return it, or None.
+        """
+        self._lock.acquire()
+        try:
+            entry = self._engines.pop(key, None)
+        finally:
+            self._lock.release()
+        if entry is not None:
+            return entry[0]
+
+    def sweep(self):
+        """Evict engines over the bounds and dispose of retired engines.
+
+        This happens automatically when engines are added or looked up,
+        but can be called to release idle engines sooner.
+        """
+        evicted = []
+        self._lock.acquire()
+        try:
+            now = time.monotonic()
+            if self.idle_ttl is not None:
+                expired = now - self.idle_ttl
+                for key, (engine, last_used, dispose) in list(
+                        self._engines.items()):
+                    if last_used <= expired:
+                        evicted.append(self._engines.pop(key))
+                self._next_sweep = now + self.idle_ttl / 2
+            else:
+                self._next_sweep = float('inf')
+            if self.maxsize is not None:
+                while len(self._engines) > self.maxsize:
+                    evicted.append(self._engines.popitem(last=False)[1])
+            self.evictions += len(evicted)
+            retired = self._retired + [
+                (engine, dispose) for engine, last_used, dispose in evicted]
+            self._retired = []
+            self._checkedIn = False
+            disposable = []
+            for engine, dispose in retired:
+                # listen first, so that a checkin right after the check
+                # isn't missed
+                self._listen(engine)
+                if checked_out(engine):
+                    self._retired.append((engine, dispose))
+                else:
+                    disposable.append((engine, dispose))
+        finally:
+            self._lock.release()
+        # dispose outside the lock, closing connections may take a while
+        for engine, dispose in disposable:
+            dispose(engine)
+
+    def _listen(self, engine):
+        # asyncio engines keep their pool on the synchronous engine
+        pool = getattr(engine, 'sync_engine', engine).pool
+        if not event.contains(pool, 'checkin', self._checkin):
+            event.listen(pool, 'checkin', self._checkin)
+
+    def _checkin(self, dbapi_connection, connection_record):
+        self._checkedIn = True
+
+    def forked(self):
+        """Make the engines safe to use in a child process.
+
+        Their pools are replaced without closing the connections, which
+        are shared with the parent process.
+        """
+        # another thread may have held the lock when the process forked
+        self._lock = threading.Lock()
+        for engine, last_used, dispose in self._engines.values():
+            # asyncio engines keep their pool on the synchronous engine
+            getattr(engine, 'sync_engine', engine).dispose(close=False)
+        # their connections belong to the parent
+        self._retired = []
+
+    def stats(self):
+        """Return a dictionary with the counters and size of the registry.
+        """
+        return {
+            'size': len(self._engines),
+            'retired': len(self._retired),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+class SessionRegistry(ScopedRegistry):
+    """Sessions by scope, closed when the thread that created them ends.
+
+    Sessions are owned by the thread (or, with gevent's patched
+    ``threading.local``, the greenlet) they were created in, and are
+    closed and forgotten when it ends, so that scopes of dead threads
+    don't pile up and a reused thread id gets a new session.
+
+    ``scope`` returns the scope strategy of the scopes ``scopefunc``
+    returns, see z3c.saconfig.scopes; with other strategies than the
+    default, sessions are owned by their greenlet or context scope.
+
+    With ``idle_ttl``, a thread also closes its sessions that were not
+    used for that many seconds, for instance those of sites it no longer
+    serves. Sessions in a transaction are kept until it is over.
+    """
+
+    def __init__(self, createfunc, scopefunc, idle_ttl=None, scope=None):
+        super().__init__(createfunc, scopefunc)
+        self.scope = scope if scope is not None else _thread_scope
+        # the storage of the owners of sessions, by scope strategy
+        self._locals = {}
+        self.idle_ttl = idle_ttl
+
+    @property
+    def _local(self):
+        scope = self.scope()
+        try:
+            return self._locals[scope]
+        except KeyError:
+            return self._locals.setdefault(scope, scope.local())
+
+    def __call__(self):
+        key = self.scopefunc()
+        try:
+            session = self.registry[key]
+        except KeyError:
+            session = self.registry.setdefault(key, self.createfunc())
+            self._owner().used[key] = time.monotonic()
+        if self.idle_ttl is not None:
+            self._touch(key)
+        return session
+
+    def set(self, obj):
+        key = self.scopefunc()
+        self.registry[key] = obj
+        self._owner().used[key] = time.monotonic()
+
+    def clear(self):
+        key = self.scopefunc()
+        self.registry.pop(key, None)
+        owner = getattr(self._local, 'owner', None)
+        if owner is not None:
+            owner.used.pop(key, None)
+
+    def forked(self):
+        """Forget the sessions, in a child process.
+
+        Returns them: they should be kept referenced, as their connections
+        are shared with the parent process and must not be closed.
+        """
+        sessions = list(self.registry.values())
+        self.registry.clear()
+        self._locals = {}
+        return sessions
+
+    def _owner(self):
+        try:
+            return self._local.owner
+        except AttributeError:
+            owner = self._local.owner = _Owner(self)
+            return owner
+
+    def _touch(self, key):
+        owner = self._owner()
+        now = owner.used[key] = time.monotonic()
+        if now < owner.next_sweep:
+            return
+        expired = now - self.idle_ttl
+        for key, last_used in list(owner.used.items()):
+            if last_used > expired:
+                continue
+            session = self.registry.get(key)
+            if session is not None and session.in_transaction():
+                continue
+            del owner.used[key]
+            self._close(self.registry.pop(key, None))
+        owner.next_sweep = now + self.idle_ttl / 2
+
+    def _release(self, used):
+        """Close the sessions of a thread that ended.
+        """
+        for key in list(used):
+            self._close(self.registry.pop(key, None))
+
+    def _close(self, session):
+        if session is None:
+            return
+        try:
+            session.close()
+        except Exception:
+            logger.exception("Could not close session %r", session)
+
+
+def _thread_scope():
+    return THREAD
+
+
+class _Owner:
+    """The scopes a thread created sessions in, by time of last use.
+
+    Lives in a ``threading.local``, or the local of another scope
+    strategy, so it goes away with its thread.
+    """
+
+    __slots__ = ('used', 'next_sweep', '__weakref__')
+
+    def __init__(self, registry):
+        self.used = {}
+        self.next_sweep = 0
+        # refer to the scopes, not to self, or it would never be collected
+        finalizer = weakref.finalize(self, registry._release, self.used)
+        # at exit, engines may be gone already
+        finalizer.atexit = False
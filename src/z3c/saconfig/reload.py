@@ -0,0 +1,116 @@
+"""
+Reconfiguring engine factories when a configuration file changes.
+
+``watch`` checks a JSON file every few seconds and calls ``reconfigure``
+on an engine factory with its contents when it changes, so that the URL
+or pool settings of the engines of a running process can be changed
+without a restart. The file holds an object with the keyword arguments
+for ``sqlalchemy.create_engine``, and optionally the ``url``::
+
+  {"url": "postgresql://db2/app", "pool_size": 20, "pool_timeout": 10}
+
+Keyword arguments that are not in the file keep their configured value.
+A file that can't be read or parsed is logged and otherwise ignored, so
+a half written file doesn't break the engine.
+"""
+import json
+import logging
+import os
+import threading
+
+
+logger = logging.getLogger('z3c.saconfig')
+
+_WATCHERS = []
+
+
+class ConfigWatcher:
+    """Reconfigures an engine factory when a JSON file changes.
+    """
+
+    def __init__(self, factory, path, interval=5.0, prefill=0):
+        self.factory = factory
+        self.path = path
+        self.interval = interval
+        self.prefill = prefill
+        self._stamp = None
+        self._stop = None
+
+    def check(self):
+        """Reconfigure the engine factory if the file changed.
+
+        The first check reconfigures it if the file exists. Returns
+        whether it was reconfigured.
+        """
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return False
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        if stamp == self._stamp:
+            return False
+        with open(self.path) as f:
+            kw = json.load(f)
+        # only once it could be read, a failure is retried
+        self._stamp = stamp
+        url = kw.pop('url', None)
+        args = () if url is None else (url, )
+        self.factory.reconfigure(*args, prefill=self.prefill, **kw)
+        logger.info("Reconfigured engine from %s", self.path)
+        return True
+
+    def start(self):
+        """Check the file every ``interval`` seconds in a daemon thread.
+        """
+        if self._stop is not None:
+            return
+        self._stop = stop = threading.Event()
+        thread = threading.Thread(
+            target=self._watch, args=(stop, ),
+            name='z3c.saconfig watch', daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        if self._stop is not None:
+            self._stop.set()
+            self._stop = None
+
+    def _watch(self, stop):
+        while True:
+            try:
+                self.check()
+            except Exception:
+                logger.exception("Could not reconfigure engine from %s",
+                                 self.path)
+            if stop.wait(self.interval):
+                return
+
+
+def watch(factory, path, interval=5.0, prefill=0):
+    """Reconfigure an engine factory whenever a JSON file changes.
+
+    The file is checked right away and then every ``interval`` seconds in
+    a background thread. New engines are prefilled with ``prefill``
+    connections before they replace the old ones. Returns the started
+    ConfigWatcher.
+    """
+    watcher = ConfigWatcher(factory, path, interval, prefill)
+    watcher.start()
+    _WATCHERS.append(watcher)
+    return watcher
+
+
+def stop_watching():
+    """Stop all watchers started with ``watch``.
+    """
+    while _WATCHERS:
+        _WATCHERS.pop().stop()
+
+
+try:
+    from zope.testing.cleanup import addCleanUp
+except ImportError:  # pragma: no cover
+    pass
+else:
+    addCleanUp(stop_watching)
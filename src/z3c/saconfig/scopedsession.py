@@ -1,7 +1,10 @@
 from sqlalchemy.orm import scoped_session
-from zope import component
 
+from z3c.saconfig.interfaces import IAsyncScopedSession
 from z3c.saconfig.interfaces import IScopedSession
+from z3c.saconfig.lookup import get_utility
+from z3c.saconfig.registry import SessionRegistry
+from z3c.saconfig.scopes import THREAD
 
 
 def session_factory(name=''):
@@ -9,7 +12,7 @@ def session_factory(name=''):
 
     It delegates to a IScopedSession utility.
     """
-    utility = component.getUtility(IScopedSession, name)
+    utility = get_utility(IScopedSession, name)
     return utility.sessionFactory()
 
 
@@ -18,14 +21,33 @@ def scopefunc(name=''):
 
     It delegates to a IScopedSession utility.
     """
-    utility = component.getUtility(IScopedSession, name)
+    utility = get_utility(IScopedSession, name)
     return utility.scopeFunc()
 
+
+def scope_strategy(name=''):
+    """Get the scope strategy of the scopes of a IScopedSession utility.
+
+    See z3c.saconfig.scopes; utilities without one are scoped by thread.
+    """
+    utility = get_utility(IScopedSession, name)
+    return getattr(utility, 'scope', THREAD)
+
+
+_IDLE_TTL = None
+
+
+def _scoped_session(createfunc, scopefunc, scope):
+    session = scoped_session(createfunc, scopefunc)
+    session.registry = SessionRegistry(
+        createfunc, scopefunc, _IDLE_TTL, scope)
+    return session
+
 # this is framework central configuration. Use a IScopedSession utility
 # to define behavior.
 
 
-Session = scoped_session(session_factory, scopefunc)
+Session = _scoped_session(session_factory, scopefunc, scope_strategy)
 
 _named_scoped_sessions = {'': Session}
 
@@ -36,6 +58,73 @@ def named_scoped_session(name):
     except KeyError:
         return _named_scoped_sessions.setdefault(
             name,
-            scoped_session(
+            _scoped_session(
                 lambda: session_factory(name),
-                lambda: scopefunc(name)))
+                lambda: scopefunc(name),
+                lambda: scope_strategy(name)))
+
+
+# sessions inherited from a parent process, see after_fork
+_INHERITED = []
+
+
+def forget_sessions():
+    """Forget the sessions of all scoped sessions after a fork.
+
+    They are kept alive, but not used, so that their connections are never
+    closed from the child process.
+    """
+    for session in list(_named_scoped_sessions.values()):
+        _INHERITED.extend(session.registry.forked())
+
+
+def configure_session_cleanup(idle_ttl=None):
+    """Close sessions that were not used for ``idle_ttl`` seconds.
+
+    This applies to ``Session`` and all named scoped sessions. Sessions
+    are checked by the thread that owns them, when it gets a session.
+    None means sessions are only closed when their thread ends.
+    """
+    global _IDLE_TTL
+    _IDLE_TTL = idle_ttl
+    for session in list(_named_scoped_sessions.values()):
+        session.registry.idle_ttl = idle_ttl
+
+
+try:
+    from zope.testing.cleanup import addCleanUp
+except ImportError:  # pragma: no cover
+    pass
+else:
+    addCleanUp(configure_session_cleanup)
+
+
+def async_session_factory(name=''):
+    """Create a new AsyncSession using a IAsyncScopedSession utility.
+    """
+    utility = get_utility(IAsyncScopedSession, name)
+    return utility.sessionFactory()
+
+
+def async_scopefunc(name=''):
+    """Distinguish between async sessions using a IAsyncScopedSession utility.
+    """
+    utility = get_utility(IAsyncScopedSession, name)
+    return utility.scopeFunc()
+
+
+_named_async_scoped_sessions = {}
+
+
+def named_async_scoped_session(name=''):
+    try:
+        return _named_async_scoped_sessions[name]
+    except KeyError:
+        pass
+    # sqlalchemy.ext.asyncio is slow to import, load it when used
+    from sqlalchemy.ext.asyncio import async_scoped_session
+    return _named_async_scoped_sessions.setdefault(
+        name,
+        async_scoped_session(
+            lambda: async_session_factory(name),
+            lambda: async_scopefunc(name)))
@@ -0,0 +1,164 @@
+"""
+Strategies for the scope of the sessions of scoped session utilities.
+
+GloballyScopedSession and SiteScopedSession keep a session per unit of
+concurrency, selected with their ``scope`` argument or the ``scope``
+attribute of the ``<db:session>`` directive:
+
+- ``thread``: a session per thread, the default. With gevent's
+  monkey-patching of ``threading`` this is a session per greenlet.
+- ``greenlet``: a session per greenlet, whether ``threading`` is patched
+  or not. This needs the ``greenlet`` package.
+- ``context``: a session per scope started with ``new_scope``, kept in a
+  context variable. A context without one gets its own the first time it
+  needs a session, which contexts copied from it, like those of asyncio
+  tasks it creates afterwards, share.
+
+The sessions of a unit are closed and forgotten when it is gone: the
+registry keeps the scopes a unit used in storage that goes away with the
+unit, rather than sweeping all scopes.
+"""
+import contextvars
+import threading
+import weakref
+
+
+class Scope:
+    """A scope strategy.
+
+    ``ident`` returns an identifier of the current unit of concurrency,
+    ``local`` a new storage of values per unit.
+    """
+
+    name = None
+
+    def ident(self):
+        raise NotImplementedError
+
+    def local(self):
+        raise NotImplementedError
+
+    def __reduce__(self):
+        # a utility that is pickled keeps using the shared instance
+        return (get_scope, (self.name, ))
+
+
+class ThreadScope(Scope):
+    """Sessions per thread."""
+
+    name = 'thread'
+    ident = staticmethod(threading.get_ident)
+
+    def local(self):
+        return threading.local()
+
+
+class GreenletScope(Scope):
+    """Sessions per greenlet."""
+
+    name = 'greenlet'
+
+    def __init__(self):
+        from greenlet import getcurrent
+        self.current = getcurrent
+
+    def ident(self):
+        # the greenlet's sessions are forgotten before its id is reused
+        return id(self.current())
+
+    def local(self):
+        return WeakLocal(self.current)
+
+
+class _ContextUnit:
+    """A unit of the context scope."""
+
+    __slots__ = ('__weakref__', )
+
+
+_CONTEXT_SCOPE = contextvars.ContextVar('z3c.saconfig.scope')
+
+
+def new_scope():
+    """Start a new scope for the current context, for ``context`` scopes.
+
+    Sessions got from now on in this context, and in contexts copied from
+    it afterwards, are those of the new scope. Returns a token to restore
+    the previous one with ``contextvars.ContextVar.reset``.
+    """
+    return _CONTEXT_SCOPE.set(_ContextUnit())
+
+
+def current_scope():
+    """Return the scope of the current context, starting one if needed.
+    """
+    try:
+        return _CONTEXT_SCOPE.get()
+    except LookupError:
+        scope = _ContextUnit()
+        _CONTEXT_SCOPE.set(scope)
+        return scope
+
+
+class ContextScope(Scope):
+    """Sessions per scope of a context variable."""
+
+    name = 'context'
+
+    def ident(self):
+        return id(current_scope())
+
+    def local(self):
+        return WeakLocal(current_scope)
+
+
+class WeakLocal:
+    """Attributes per unit of a scope, like ``threading.local``.
+
+    ``current`` returns the object standing for the current unit, whose
+    attributes go away when it is garbage collected.
+    """
+
+    __slots__ = ('_current', '_units')
+
+    def __init__(self, current):
+        object.__setattr__(self, '_current', current)
+        object.__setattr__(self, '_units', weakref.WeakKeyDictionary())
+
+    def __getattr__(self, name):
+        try:
+            return self._units[self._current()][name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def __setattr__(self, name, value):
+        unit = self._current()
+        values = self._units.get(unit)
+        if values is None:
+            values = self._units[unit] = {}
+        values[name] = value
+
+
+SCOPES = {
+    'thread': ThreadScope,
+    'greenlet': GreenletScope,
+    'context': ContextScope,
+}
+
+_INSTANCES = {}
+
+THREAD = _INSTANCES['thread'] = ThreadScope()
+
+
+def get_scope(name):
+    """Get the scope strategy of a name in SCOPES.
+    """
+    try:
+        return _INSTANCES[name]
+    except KeyError:
+        pass
+    try:
+        class_ = SCOPES[name]
+    except KeyError:
+        raise ValueError("Unknown session scope: %r" % name) from None
+    return _INSTANCES.setdefault(name, class_())
@@ -0,0 +1,94 @@
+"""
+SQLAlchemy session classes used by the IScopedSession utilities.
+"""
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.selectable import GenerativeSelect
+
+
+class FactorySession(Session):
+    """A session using the engine its engine factory currently provides.
+
+    ``engine_factory`` is called for the engine when a transaction of the
+    session needs one, rather than once when the session is created, so
+    that long lived sessions follow resets, reconfigurations and
+    failovers of the factory. A transaction keeps using the engine it
+    began with. Without ``engine_factory``, the ``bind`` argument is used
+    as usual.
+    """
+
+    def __init__(self, engine_factory=None, **kw):
+        self.engine_factory = engine_factory
+        # the engine of the current transaction, and the last one the
+        # factory provided outside of one
+        self._engine = self._candidate = None
+        super().__init__(**kw)
+        if engine_factory is not None:
+            event.listen(self, 'after_begin', _keep_engine)
+            event.listen(self, 'after_transaction_end', _forget_engine)
+
+    @property
+    def bind(self):
+        if self.engine_factory is None:
+            return self._bind
+        engine = self._engine
+        if engine is None:
+            engine = self._candidate = self.engine_factory()
+        return engine
+
+    @bind.setter
+    def bind(self, bind):
+        self._bind = bind
+
+
+def _keep_engine(session, transaction, connection):
+    # get_bind asks before the transaction begins with its connection
+    if session._engine is None and connection.engine is session._candidate:
+        session._engine = session._candidate
+        session._candidate = None
+
+
+def _forget_engine(session, transaction):
+    if transaction.parent is None:
+        session._engine = session._candidate = None
+
+
+class RoutingSession(Session):
+    """A session that sends reads to replica databases.
+
+    ``router`` is an ``IRoutingEngineFactory``. Plain SELECT statements
+    go to one of its replicas, everything else to its primary engine:
+    flushes, data changing and textual statements, and SELECT ... FOR
+    UPDATE. Once the session has flushed or executed anything but a
+    plain SELECT, it sticks to the primary until the end of the
+    transaction, so that it reads its own writes.
+    """
+
+    def __init__(self, router, **kw):
+        super().__init__(**kw)
+        self.router = router
+        self._use_primary = False
+        event.listen(self, 'after_flush', _stick_to_primary)
+        event.listen(self, 'after_transaction_end', _unstick)
+
+    def get_bind(self, mapper=None, *, clause=None, bind=None, **kw):
+        if bind is not None:
+            return bind
+        if self._flushing or self._use_primary:
+            return self.router()
+        if (isinstance(clause, GenerativeSelect)
+                and clause._for_update_arg is None):
+            return self.router.replica()
+        if clause is not None:
+            # it may write, read what it wrote from now on
+            self._use_primary = True
+        return self.router()
+
+
+def _stick_to_primary(session, flush_context):
+    session._use_primary = True
+
+
+def _unstick(session, transaction):
+    if transaction.parent is None:
+        session._use_primary = False
@@ -0,0 +1,138 @@
+"""
+Sharing a database connection between the sessions of a Zope transaction.
+
+Sessions of scoped session utilities created with ``share_connection``
+use the connection that ``shared_connection`` returns for their engine,
+instead of checking out a connection of their own. Within a Zope
+transaction all of them use one connection, and one database transaction,
+per engine.
+
+The sessions join the database transaction of the connection without
+committing it; a ``SharedConnection`` data manager commits it when the
+Zope transaction commits, after the sessions flushed. Two-phase commit is
+used only when sessions of the transaction share connections of more
+than one engine, and asked for ``twophase``.
+"""
+import transaction
+from sqlalchemy.engine import Connection
+from transaction.interfaces import IDataManager
+from transaction.interfaces import IDataManagerSavepoint
+from zope.interface import implementer
+
+
+@implementer(IDataManager)
+class SharedConnection:
+    """Commits or rolls back a shared connection with the Zope transaction.
+    """
+
+    def __init__(self, engine, shared, twophase=False,
+                 transaction_manager=transaction.manager):
+        self.connection = engine.connect()
+        if twophase:
+            self.tx = self.connection.begin_twophase()
+        else:
+            self.tx = self.connection.begin()
+        self.transaction_manager = transaction_manager
+        self.twophase = twophase
+        self.prepared = False
+        # the shared connections of the Zope transaction, by engine
+        self._shared = shared
+
+    def _finish(self):
+        connection, self.connection = self.connection, None
+        self.tx = None
+        connection.close()
+
+    def abort(self, txn):
+        if self.connection is None:
+            return
+        # not if it committed in tpc_vote
+        if self.prepared or self.tx.is_active:
+            self.tx.rollback()
+        self._finish()
+
+    def tpc_begin(self, txn):
+        pass
+
+    def commit(self, txn):
+        pass
+
+    def tpc_vote(self, txn):
+        if self.twophase and len(self._shared) > 1:
+            self.tx.prepare()
+            self.prepared = True
+        else:
+            # one phase, last, as zope.sqlalchemy does
+            self.tx.commit()
+
+    def tpc_finish(self, txn):
+        if self.prepared:
+            self.tx.commit()
+        self._finish()
+
+    def tpc_abort(self, txn):
+        self.abort(txn)
+
+    def sortKey(self):
+        # after the sessions, which flush in tpc_begin and "commit" in
+        # tpc_vote without committing the connection
+        return "~sqlalchemy~shared:%d" % id(self)
+
+    def savepoint(self):
+        # the sessions make the savepoints of the connection
+        return _Savepoint(self)
+
+
+@implementer(IDataManagerSavepoint)
+class _Savepoint:
+
+    def __init__(self, dm):
+        self.dm = dm
+
+    def rollback(self):
+        pass
+
+
+def shared_connection(engine, twophase=False,
+                      transaction_manager=transaction.manager):
+    """Get the connection of an engine shared in the current transaction.
+
+    The connection is checked out and its transaction begun on the first
+    call in a Zope transaction; it is returned to the pool when the Zope
+    transaction ends.
+    """
+    txn = transaction_manager.get()
+    try:
+        shared = txn.data(SharedConnection)
+    except KeyError:
+        shared = {}
+        txn.set_data(SharedConnection, shared)
+    dm = shared.get(engine)
+    if dm is None:
+        dm = shared[engine] = SharedConnection(
+            engine, shared, twophase, transaction_manager)
+        txn.join(dm)
+    return dm.connection
+
+
+class SharingSession:
+    """A session mixin using the shared connections of its engines.
+    """
+
+    shared_twophase = False
+
+    def get_bind(self, mapper=None, **kw):
+        bind = super().get_bind(mapper, **kw)
+        if isinstance(bind, Connection):
+            return bind
+        return shared_connection(bind, self.shared_twophase)
+
+
+def sharing_session_class(class_, twophase=False):
+    """Make a session class sharing connections, based on a session class.
+
+    With ``twophase``, the shared connections use two-phase commit; the
+    sessions themselves don't commit them.
+    """
+    return type(class_.__name__, (SharingSession, class_),
+                {'shared_twophase': twophase})
@@ -0,0 +1,291 @@
+"""
+Connection pool statistics shared by the worker processes of a server.
+
+Each process has its own engines and pools. ``export_pool_stats`` makes
+the instrumented engine factories of a process write their statistics to
+a memory-mapped file that all workers share, and ``shared_pool_stats``
+adds them up per engine name, for instance to compare the connections of
+all workers to the ``max_connections`` of the database.
+
+The file has a fixed number of slots. A process claims a slot per engine
+the first time it writes, and is the only one writing to it, so updates
+don't need a lock. Slots of processes that are gone are skipped by
+readers and reused. Readers retry slots that are being written.
+"""
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+from zope import component
+
+from z3c.saconfig.interfaces import IEngineFactory
+from z3c.saconfig.lookup import get_utility
+
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+logger = logging.getLogger('z3c.saconfig')
+
+MAGIC = b'SAPS'
+
+# magic, version, number of slots
+_HEADER = struct.Struct('<4sII')
+# sequence (odd while being written), process id, engine name, open
+# connections, checked out, overflow, checkouts, timeouts, checkout time
+_SLOT = struct.Struct('<Qq64sqqqqqd')
+
+# bytes of UTF-8 encoded engine names, longer ones are shortened
+_NAME_SIZE = 64
+
+_FIELDS = ('open_connections', 'checked_out', 'overflow', 'checkouts',
+           'timeouts', 'checkout_time')
+
+
+class SharedStatsFile:
+    """A memory-mapped file with slots for pool statistics.
+
+    The file is created with room for ``slots`` engines of all processes
+    together if it doesn't exist yet.
+    """
+
+    def __init__(self, path, slots=256):
+        self.path = path
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            self._lock(fd)
+            try:
+                if os.fstat(fd).st_size == 0:
+                    os.ftruncate(fd, _HEADER.size + slots * _SLOT.size)
+                    os.pwrite(fd, _HEADER.pack(MAGIC, 1, slots), 0)
+                self._mmap = mmap.mmap(fd, 0)
+            finally:
+                self._unlock(fd)
+        except BaseException:
+            os.close(fd)
+            raise
+        self._fd = fd
+        magic, version, self.slots = _HEADER.unpack_from(self._mmap)
+        if magic != MAGIC or version != 1:
+            self.close()
+            raise ValueError("Not a pool statistics file: %s" % path)
+
+    def _lock(self, fd):
+        # lockf locks belong to the process, unlike flock locks, which a
+        # forked child shares with its parent
+        if fcntl is not None:
+            fcntl.lockf(fd, fcntl.LOCK_EX)
+
+    def _unlock(self, fd):
+        if fcntl is not None:
+            fcntl.lockf(fd, fcntl.LOCK_UN)
+
+    def _offset(self, slot):
+        return _HEADER.size + slot * _SLOT.size
+
+    def claim(self, name):
+        """Claim a free slot for an engine of this process.
+
+        Returns its number, or None if all slots are in use.
+        """
+        pid = os.getpid()
+        self._lock(self._fd)
+        try:
+            for slot in range(self.slots):
+                sequence, owner = struct.unpack_from(
+                    '<Qq', self._mmap, self._offset(slot))
+                if owner and _alive(owner):
+                    continue
+                # even, also if the previous owner died while writing
+                _SLOT.pack_into(self._mmap, self._offset(slot),
+                                (sequence | 1) + 1, pid, _encodeName(name),
+                                0, 0, 0, 0, 0, 0.0)
+                return slot
+        finally:
+            self._unlock(self._fd)
+        return None
+
+    def write(self, slot, values):
+        """Write the statistics of a claimed slot.
+        """
+        offset = self._offset(slot)
+        sequence, pid, name = _SLOT.unpack_from(self._mmap, offset)[:3]
+        # odd while writing, so that readers know to try again
+        struct.pack_into('<Q', self._mmap, offset, sequence + 1)
+        _SLOT.pack_into(self._mmap, offset, sequence + 1, pid, name,
+                        *values)
+        struct.pack_into('<Q', self._mmap, offset, sequence + 2)
+
+    def read(self):
+        """Return (process id, engine name, statistics) of live processes.
+        """
+        entries = []
+        for slot in range(self.slots):
+            values = self._readSlot(self._offset(slot))
+            if values is None:
+                continue
+            pid, name = values[1:3]
+            if pid and _alive(pid):
+                entries.append((pid, name.rstrip(b'\0').decode('utf-8'),
+                                dict(zip(_FIELDS, values[3:]))))
+        return entries
+
+    def _readSlot(self, offset):
+        for attempt in range(100):
+            values = _SLOT.unpack_from(self._mmap, offset)
+            if values[0] % 2 == 0 and struct.unpack_from(
+                    '<Q', self._mmap, offset)[0] == values[0]:
+                return values
+            time.sleep(0)
+        # a writer that died halfway
+        return None
+
+    def close(self):
+        self._mmap.close()
+        os.close(self._fd)
+
+
+def _encodeName(name):
+    """Encode an engine name, shortened to whole characters if needed.
+    """
+    encoded = name.encode('utf-8')
+    if len(encoded) <= _NAME_SIZE:
+        return encoded
+    return encoded[:_NAME_SIZE].decode('utf-8', 'ignore').encode('utf-8')
+
+
+def _alive(pid):
+    if os.name == 'nt':  # pragma: no cover
+        # os.kill would terminate the process
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # a process of another user
+        return True
+    return True
+
+
+class PoolStatsExporter:
+    """Writes the statistics of a PoolStats object to a shared file.
+
+    It is one of the listeners of the PoolStats object. A process claims
+    its slot when it first writes, so that forked workers each have one.
+    """
+
+    def __init__(self, stats_file, name):
+        self.stats_file = stats_file
+        self.name = name
+        self._pid = None
+        self._slot = None
+        self._lock = threading.Lock()
+
+    def __call__(self, stats):
+        # wait for a thread writing now, it may write older numbers
+        self._lock.acquire()
+        try:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._slot = self.stats_file.claim(self.name)
+                if self._slot is None:
+                    logger.warning("No free slot for the pool statistics "
+                                   "of engine %r in %s", self.name,
+                                   self.stats_file.path)
+            if self._slot is not None:
+                self.stats_file.write(self._slot, (
+                    stats.open_connections, stats.checked_out,
+                    stats.overflow, stats.checkouts, stats.timeouts,
+                    stats.checkout_time))
+        finally:
+            self._lock.release()
+
+    def forked(self):
+        # another thread may have held the lock when the process forked
+        self._lock = threading.Lock()
+
+
+_EXPORTS = []
+
+
+def export_pool_stats(path, names=None, slots=256):
+    """Write the pool statistics of engine factories to a shared file.
+
+    ``names`` are the names of engine factory utilities; by default all
+    instrumented ones are exported. The file is created with ``slots``
+    slots if needed; every engine of every process takes one. Names are
+    kept to 64 bytes of UTF-8.
+    """
+    if names is None:
+        names = sorted(name for name, factory in
+                       component.getUtilitiesFor(IEngineFactory)
+                       if getattr(factory, 'stats', None) is not None)
+    stats_file = SharedStatsFile(path, slots)
+    for name in names:
+        stats = getattr(get_utility(IEngineFactory, name), 'stats', None)
+        if stats is not None:
+            exporter = PoolStatsExporter(stats_file, name)
+            stats.listeners.append(exporter)
+            _EXPORTS.append((stats, exporter))
+    return stats_file
+
+
+def stop_exporting():
+    """Stop writing pool statistics to shared files.
+    """
+    files = set()
+    while _EXPORTS:
+        stats, exporter = _EXPORTS.pop()
+        stats.listeners.remove(exporter)
+        files.add(exporter.stats_file)
+    for stats_file in files:
+        stats_file.close()
+
+
+def _forked():
+    for stats, exporter in _EXPORTS:
+        exporter.forked()
+
+
+if hasattr(os, 'register_at_fork'):
+    # not on Windows, which doesn't fork
+    os.register_at_fork(after_in_child=_forked)
+
+
+def shared_pool_stats(path):
+    """Add up the pool statistics in a shared file per engine name.
+
+    Returns a dictionary of dictionaries with the number of
+    ``processes``, and the totals of ``open_connections``,
+    ``checked_out``, ``overflow``, ``checkouts``, ``timeouts`` and
+    ``checkout_time`` of the processes that are alive.
+    """
+    stats_file = SharedStatsFile(path)
+    try:
+        entries = stats_file.read()
+    finally:
+        stats_file.close()
+    totals = {}
+    for pid, name, values in entries:
+        total = totals.get(name)
+        if total is None:
+            total = totals[name] = dict.fromkeys(_FIELDS, 0)
+            total['processes'] = 0
+        total['processes'] += 1
+        for key, value in values.items():
+            total[key] += value
+    return totals
+
+
+try:
+    from zope.testing.cleanup import addCleanUp
+except ImportError:  # pragma: no cover
+    pass
+else:
+    addCleanUp(stop_exporting)
@@ -0,0 +1,278 @@
+"""
+Connection pool and statement cache statistics for engines created by
+engine factories.
+
+Pass ``instrument=True`` to an engine factory to collect them. The
+statistics of all engines a factory creates end up in its ``stats``
+attribute, a ``PoolStats`` object.
+"""
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.engine.default import CACHE_HIT
+from sqlalchemy.engine.default import CACHE_MISS
+from sqlalchemy.exc import TimeoutError
+from zope import component
+
+from z3c.saconfig.interfaces import IEngineFactory
+from z3c.saconfig.lookup import get_utility
+
+
+# upper bounds of the checkout time histogram, in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, float('inf'))
+
+_CONNECTED = 'z3c.saconfig.connected'
+
+
+class PoolStats:
+    """Statistics of the connection pools of an engine factory.
+
+    Checkout times include waiting for a free connection as well as
+    opening a new one. ``recycles`` counts connections that were replaced
+    in an existing pool slot, because of ``pool_recycle`` or an earlier
+    invalidation. ``cache_hits`` and ``cache_misses`` count statements
+    that were found in, or compiled and added to, the compiled statement
+    cache of the engine. The counters are updated without locking, so
+    they may be slightly off under heavy concurrency.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pool = None
+        # called with this object after each checkout and checkin, once
+        # the pool is up to date
+        self.listeners = []
+        self.buckets = [0] * len(BUCKETS)
+        self.checkout_time = 0.0
+        self.checkouts = 0
+        self.checkins = 0
+        self.connects = 0
+        self.recycles = 0
+        self.invalidations = 0
+        self.timeouts = 0
+        self.overflow_peak = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def attach(self, engine):
+        """Collect statistics of the pool of an engine.
+        """
+        # asyncio engines keep their pool on the synchronous engine
+        engine = getattr(engine, 'sync_engine', engine)
+        event.listen(engine, 'connect', self._connected)
+        event.listen(engine, 'checkout', self._checkedOut)
+        event.listen(engine, 'checkin', self._checkedIn)
+        event.listen(engine, 'invalidate', self._invalidated)
+        event.listen(engine, 'engine_disposed', self._disposed)
+        event.listen(engine, 'before_cursor_execute', self._executing)
+        self._wrapPool(engine.pool)
+
+    def _wrapPool(self, pool):
+        # there are no pool events before a checkout and after a checkin,
+        # so wrap the methods doing them
+        connect = pool.connect
+        return_conn = pool._return_conn
+
+        def timed_connect():
+            start = time.perf_counter()
+            try:
+                return connect()
+            except TimeoutError:
+                self.timeouts += 1
+                raise
+            finally:
+                self.observeCheckout(time.perf_counter() - start)
+
+        def notifying_return_conn(record):
+            return_conn(record)
+            for listener in self.listeners:
+                listener(self)
+
+        pool.connect = timed_connect
+        pool._return_conn = notifying_return_conn
+        self._pool = pool
+
+    def _disposed(self, engine):
+        # disposing an engine replaces its pool
+        self._wrapPool(engine.pool)
+
+    def _connected(self, dbapi_connection, connection_record):
+        self.connects += 1
+        if _CONNECTED in connection_record.record_info:
+            self.recycles += 1
+        connection_record.record_info[_CONNECTED] = True
+
+    def _checkedOut(self, dbapi_connection, connection_record,
+                    connection_proxy):
+        self.checkouts += 1
+        overflow = self.overflow
+        if overflow > self.overflow_peak:
+            self.overflow_peak = overflow
+
+    def _checkedIn(self, dbapi_connection, connection_record):
+        self.checkins += 1
+
+    def _invalidated(self, dbapi_connection, connection_record, exception):
+        self.invalidations += 1
+
+    def _executing(self, conn, cursor, statement, parameters, context,
+                   executemany):
+        cache_hit = getattr(context, 'cache_hit', None)
+        if cache_hit is CACHE_HIT:
+            self.cache_hits += 1
+        elif cache_hit is CACHE_MISS:
+            self.cache_misses += 1
+
+    def observeCheckout(self, seconds):
+        """Record the time a checkout took.
+        """
+        for index, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                break
+        self._lock.acquire()
+        try:
+            self.buckets[index] += 1
+            self.checkout_time += seconds
+        finally:
+            self._lock.release()
+        for listener in self.listeners:
+            listener(self)
+
+    @property
+    def checked_out(self):
+        """The number of connections currently in use."""
+        return _poolValue(self._pool, 'checkedout')
+
+    @property
+    def open_connections(self):
+        """The number of connections currently open, in use or not."""
+        return self.checked_out + _poolValue(self._pool, 'checkedin')
+
+    @property
+    def overflow(self):
+        """The number of connections currently open beyond the pool size."""
+        return max(_poolValue(self._pool, 'overflow'), 0)
+
+    @property
+    def cache_hit_rate(self):
+        """The share of cacheable statements found in the cache, or None."""
+        lookups = self.cache_hits + self.cache_misses
+        if not lookups:
+            return None
+        return self.cache_hits / lookups
+
+    def snapshot(self):
+        """Return the statistics as a dictionary.
+        """
+        self._lock.acquire()
+        try:
+            buckets = list(self.buckets)
+            checkout_time = self.checkout_time
+        finally:
+            self._lock.release()
+        return {
+            'checkout_buckets': list(zip(BUCKETS, buckets)),
+            'checkout_time': checkout_time,
+            'checkout_count': sum(buckets),
+            'checked_out': self.checked_out,
+            'overflow': self.overflow,
+            'overflow_peak': self.overflow_peak,
+            'checkouts': self.checkouts,
+            'checkins': self.checkins,
+            'connects': self.connects,
+            'recycles': self.recycles,
+            'invalidations': self.invalidations,
+            'timeouts': self.timeouts,
+            'cache_hits': self.cache_hits,
+            'cache_misses': self.cache_misses,
+            'cache_hit_rate': self.cache_hit_rate,
+        }
+
+
+def _poolValue(pool, name):
+    try:
+        return getattr(pool, name)()
+    except (AttributeError, TypeError):
+        # not all pool classes keep track of this
+        return 0
+
+
+def pool_stats(name=''):
+    """Get the PoolStats of the engine factory registered under name.
+
+    Returns None if the factory is not instrumented.
+    """
+    return getattr(get_utility(IEngineFactory, name), 'stats', None)
+
+
+_COUNTERS = (
+    ('checkouts', 'Connections checked out of the pool.'),
+    ('checkins', 'Connections checked in to the pool.'),
+    ('connects', 'Connections opened by the pool.'),
+    ('recycles', 'Connections replaced in an existing pool slot.'),
+    ('invalidations', 'Connections invalidated.'),
+    ('timeouts', 'Checkouts that timed out waiting for a connection.'),
+    ('cache_hits', 'Statements found in the compiled statement cache.'),
+    ('cache_misses', 'Statements compiled and added to the cache.'),
+)
+
+_GAUGES = (
+    ('checked_out', 'Connections currently in use.'),
+    ('overflow', 'Connections currently open beyond the pool size.'),
+    ('overflow_peak', 'Most connections open beyond the pool size.'),
+)
+
+
+def format_pool_stats(names=None, prefix='saconfig_pool'):
+    """Render pool statistics in the Prometheus text exposition format.
+
+    ``names`` are the names of engine factory utilities; by default all
+    instrumented ones are included. Engine names are used as the
+    ``engine`` label.
+    """
+    if names is None:
+        names = sorted(name for name, factory in
+                       component.getUtilitiesFor(IEngineFactory)
+                       if getattr(factory, 'stats', None) is not None)
+    snapshots = []
+    for name in names:
+        stats = pool_stats(name)
+        if stats is not None:
+            snapshots.append((name, stats.snapshot()))
+    lines = []
+
+    def header(metric, help, kind):
+        lines.append('# HELP %s_%s %s' % (prefix, metric, help))
+        lines.append('# TYPE %s_%s %s' % (prefix, metric, kind))
+
+    header('checkout_seconds', 'Time to check out a connection.',
+           'histogram')
+    for name, snapshot in snapshots:
+        label = 'engine="%s"' % _escape(name)
+        cumulative = 0
+        for bound, count in snapshot['checkout_buckets']:
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append('%s_checkout_seconds_bucket{%s,le="%s"} %d' % (
+                prefix, label, le, cumulative))
+        lines.append('%s_checkout_seconds_sum{%s} %r' % (
+            prefix, label, snapshot['checkout_time']))
+        lines.append('%s_checkout_seconds_count{%s} %d' % (
+            prefix, label, snapshot['checkout_count']))
+    for key, help in _COUNTERS:
+        header('%s_total' % key, help, 'counter')
+        for name, snapshot in snapshots:
+            lines.append('%s_%s_total{engine="%s"} %d' % (
+                prefix, key, _escape(name), snapshot[key]))
+    for key, help in _GAUGES:
+        header(key, help, 'gauge')
+        for name, snapshot in snapshots:
+            lines.append('%s_%s{engine="%s"} %d' % (
+                prefix, key, _escape(name), snapshot[key]))
+    return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
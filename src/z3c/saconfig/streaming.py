@@ -0,0 +1,64 @@
+"""
+Streaming large query results through scoped sessions.
+
+``stream`` executes a statement with the session of a scoped session and
+fetches the rows in batches, from a server side cursor where the driver
+has them, instead of loading all rows into memory at once.
+
+The result keeps a connection of the session checked out until all rows
+are read, or the stream is garbage collected. It is closed at the latest
+before the Zope transaction commits, so that the cursor doesn't get in
+the way of the commit; if the transaction aborts, closing the session
+closes it.
+"""
+import weakref
+
+import transaction
+
+from z3c.saconfig.scopedsession import named_scoped_session
+
+
+class ResultStream:
+    """The rows of a statement, fetched in batches.
+
+    Iterate over it once. Iterating to the end, breaking out of the loop,
+    calling ``close`` or dropping the stream release the cursor.
+    """
+
+    def __init__(self, result, scalars=False):
+        self._result = result
+        self._rows = result.scalars() if scalars else result
+        # for streams that are dropped before all rows are read
+        finalizer = weakref.finalize(self, result.close)
+        finalizer.atexit = False
+
+    def __iter__(self):
+        try:
+            yield from self._rows
+        finally:
+            self.close()
+
+    @property
+    def closed(self):
+        return self._result.closed
+
+    def close(self):
+        self._result.close()
+
+
+def stream(statement, name='', yield_per=1000, scalars=False, params=None):
+    """Execute a statement with a scoped session, streaming its rows.
+
+    ``name`` is the name of the scoped session, as for
+    ``named_scoped_session``. ``yield_per`` rows are fetched at a time.
+    With ``scalars``, the first column of each row is returned, for
+    instance the objects of ``select(User)``. Returns a ResultStream.
+    """
+    session = named_scoped_session(name)()
+    # yield_per implies stream_results, a server side cursor
+    result = session.execute(statement, params,
+                             execution_options={'yield_per': yield_per})
+    rows = ResultStream(result, scalars)
+    # not rows.close, which would keep the stream until the commit
+    transaction.get().addBeforeCommitHook(result.close)
+    return rows
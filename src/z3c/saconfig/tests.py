@@ -7,11 +7,23 @@
 # Since the test exercise what happens with two different DSNs
 # locally, you need to also set up a different TEST_DSN2.
 
+import contextvars
 import doctest
 import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
 
 import zope.component.eventtesting
+from sqlalchemy import create_engine
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
 # To test in twophase commit mode export TEST_TWOPHASE=True
 #
 # NOTE: The sqlite that ships with Mac OS X 10.4 is buggy.
@@ -21,6 +33,30 @@ from zope.interface import registry
 from zope.testing import cleanup
 from zope.testing.cleanup import addCleanUp
 
+from z3c.saconfig.budget import ConnectionBudget
+from z3c.saconfig.budget import ConnectionBudgetTimeout
+from z3c.saconfig.deadline import _DEADLINES
+from z3c.saconfig.deadline import _before
+from z3c.saconfig.deadline import _checkin
+from z3c.saconfig.deadline import deadline
+from z3c.saconfig.deadline import enforce_deadlines
+from z3c.saconfig.interfaces import IEngineFactory
+from z3c.saconfig.interfaces import IScopedSession
+from z3c.saconfig.registry import SessionRegistry
+from z3c.saconfig.scopedsession import _INHERITED
+from z3c.saconfig.scopedsession import named_scoped_session
+from z3c.saconfig.scopes import get_scope
+from z3c.saconfig.scopes import new_scope
+from z3c.saconfig.sharedstats import SharedStatsFile
+from z3c.saconfig.sharedstats import export_pool_stats
+from z3c.saconfig.sharedstats import shared_pool_stats
+from z3c.saconfig.streaming import ResultStream
+from z3c.saconfig.utility import OPEN
+from z3c.saconfig.utility import CircuitOpenError
+from z3c.saconfig.utility import EngineFactory
+from z3c.saconfig.utility import FailoverEngineFactory
+from z3c.saconfig.utility import GloballyScopedSession
+
 
 TEST_TWOPHASE = bool(os.environ.get('TEST_TWOPHASE'))
 TEST_DSN = os.environ.get('TEST_DSN', 'sqlite:///:memory:')
@@ -110,6 +146,595 @@ def engine_subscriber(engine):
     print(f'got: {engine!s} ')
 
 
+class SlowEngineFactory(EngineFactory):
+    """An engine factory that takes a while to create its engine.
+
+    This stands in for dialect imports and pool setup of a real database.
+    """
+
+    delay = 0.05
+
+    def __init__(self, *args, **kw):
+        super().__init__(*args, **kw)
+        self.created = 0
+
+    def _createEngine(self, args, kw):
+        self.created += 1
+        time.sleep(self.delay)
+        return super()._createEngine(args, kw)
+
+
+class EngineWarmUpTests(unittest.TestCase):
+    """Stress the engine creation path with many factories and threads."""
+
+    factories = 40
+    callers = 4
+
+    def setUp(self):
+        self._factories = [SlowEngineFactory('sqlite://')
+                           for i in range(self.factories)]
+
+    def tearDown(self):
+        for factory in self._factories:
+            factory.reset()
+
+    def _warmUp(self):
+        engines = {}
+        barrier = threading.Barrier(self.factories * self.callers)
+
+        def call(factory):
+            barrier.wait()
+            engines.setdefault(factory, set()).add(factory())
+
+        threads = [threading.Thread(target=call, args=(factory,))
+                   for factory in self._factories
+                   for i in range(self.callers)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - start, engines
+
+    def test_unrelated_engines_are_created_in_parallel(self):
+        elapsed, engines = self._warmUp()
+        serialized = self.factories * SlowEngineFactory.delay
+        self.assertLess(
+            elapsed, serialized / 4,
+            'warm-up of %d engines took %.3fs, creating them one after '
+            'the other takes %.3fs' % (self.factories, elapsed, serialized))
+
+    def test_concurrent_callers_share_one_engine(self):
+        elapsed, engines = self._warmUp()
+        for factory in self._factories:
+            self.assertEqual(factory.created, 1)
+            self.assertEqual(len(engines[factory]), 1)
+
+
+class FakeSession:
+
+    def __init__(self):
+        self.closed = False
+        self.transaction = False
+
+    def close(self):
+        self.closed = True
+
+    def in_transaction(self):
+        return self.transaction
+
+
+class SessionRegistryTests(unittest.TestCase):
+    """Sessions go away with their thread and when idle."""
+
+    def setUp(self):
+        self.scope = 'site1'
+        self.sessions = []
+        self.registry = SessionRegistry(
+            self._createSession,
+            lambda: (threading.get_ident(), self.scope))
+
+    def _createSession(self):
+        session = FakeSession()
+        self.sessions.append(session)
+        return session
+
+    def test_sessions_are_closed_when_their_thread_ends(self):
+        def work():
+            for scope in ('site1', 'site2'):
+                self.scope = scope
+                self.assertIs(self.registry(), self.registry())
+
+        threads = [threading.Thread(target=work) for i in range(20)]
+        for thread in threads:
+            thread.start()
+            thread.join()
+        self.assertEqual(len(self.sessions), 40)
+        self.assertEqual(self.registry.registry, {})
+        self.assertTrue(all(session.closed for session in self.sessions))
+
+    def test_idle_sessions_are_closed(self):
+        self.registry.idle_ttl = 0.05
+        site1 = self.registry()
+        self.scope = 'site2'
+        site2 = self.registry()
+        site2.transaction = True
+        self.scope = 'site3'
+        time.sleep(0.1)
+        self.registry()
+        self.assertTrue(site1.closed)
+        self.assertFalse(site2.closed)
+        self.scope = 'site1'
+        self.assertIsNot(self.registry(), site1)
+
+    def test_clear(self):
+        session = self.registry()
+        self.registry.clear()
+        self.assertFalse(self.registry.has())
+        self.assertIsNot(self.registry(), session)
+        self.registry.clear()
+        self.assertEqual(self.registry._local.owner.used, {})
+
+
+class ScopeTests(unittest.TestCase):
+    """Sessions per greenlet or context go away with them."""
+
+    def _registry(self, name):
+        scope = get_scope(name)
+        self.sessions = []
+        return SessionRegistry(self._createSession, scope.ident,
+                               scope=lambda: scope)
+
+    def _createSession(self):
+        session = FakeSession()
+        self.sessions.append(session)
+        return session
+
+    def test_greenlet(self):
+        greenlet = get_scope('greenlet').current
+        session_registry = self._registry('greenlet')
+        main = greenlet()
+
+        def work():
+            session = session_registry()
+            main.switch(session)
+            return session_registry() is session
+
+        greenlets = [type(main)(work) for i in range(100)]
+        sessions = [g.switch() for g in greenlets]
+        self.assertEqual(len(set(map(id, sessions))), 100)
+        self.assertEqual(len(session_registry.registry), 100)
+        self.assertTrue(all(g.switch() for g in greenlets))
+        del greenlets
+        self.assertEqual(session_registry.registry, {})
+        self.assertTrue(all(session.closed for session in self.sessions))
+
+    def test_context(self):
+        session_registry = self._registry('context')
+
+        def work():
+            new_scope()
+            return session_registry()
+
+        first = contextvars.copy_context().run(work)
+        second = contextvars.copy_context().run(work)
+        self.assertIsNot(first, second)
+        self.assertEqual(session_registry.registry, {})
+        self.assertTrue(first.closed and second.closed)
+
+    def test_unknown(self):
+        with self.assertRaises(ValueError):
+            get_scope('process')
+
+
+class FailoverTests(unittest.TestCase):
+    """The background probe fails over without help."""
+
+    def setUp(self):
+        self.factory = FailoverEngineFactory(
+            ['sqlite:////nonexistent/directory/test.db', 'sqlite://'],
+            failure_threshold=1, probe_interval=0.01)
+
+    def tearDown(self):
+        self.factory.reset()
+        for thread in self._probing():
+            thread.join(5)
+
+    def _probing(self):
+        return [thread for thread in threading.enumerate()
+                if thread.name == 'z3c.saconfig probe']
+
+    def test_probe_fails_over_in_the_background(self):
+        engine = self.factory()
+        with self.assertRaises(Exception):
+            engine.connect()
+        self.assertEqual(self.factory.state, OPEN)
+        deadline = time.monotonic() + 5
+        while self.factory.state == OPEN and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.factory.url, 'sqlite://')
+        self.assertIsNot(self.factory(), engine)
+
+    def test_sessions_follow_the_circuit(self):
+        factory = FailoverEngineFactory(
+            ['sqlite:////nonexistent/directory/test.db', 'sqlite://'],
+            failure_threshold=1, probe_interval=None)
+        component.provideUtility(factory, provides=IEngineFactory,
+                                 name='failover')
+        component.provideUtility(GloballyScopedSession(engine='failover'),
+                                 provides=IScopedSession, name='failover')
+        Session = named_scoped_session('failover')
+        try:
+            with self.assertRaises(OperationalError):
+                Session().execute(text('SELECT 1'))
+            Session().rollback()
+            # the session of the thread fails right away, then follows
+            # the factory to the other database
+            with self.assertRaises(CircuitOpenError):
+                Session().execute(text('SELECT 1'))
+            self.assertEqual(factory.probe(), 'closed')
+            self.assertEqual(Session().execute(text('SELECT 1')).scalar(),
+                             1)
+            self.assertIs(Session().bind, factory())
+        finally:
+            Session.remove()
+            factory.reset()
+            cleanup.cleanUp()
+
+    def test_reset_stops_probing(self):
+        self.factory()
+        self.assertTrue(self._probing())
+        self.factory.reset()
+        for thread in self._probing():
+            thread.join(5)
+        self.assertEqual(self._probing(), [])
+
+
+class ResultStreamTests(unittest.TestCase):
+    """A stream releases its cursor when it is dropped."""
+
+    def test_dropped_stream_closes_the_result(self):
+        engine = create_engine('sqlite://')
+        session = sessionmaker(bind=engine)()
+        result = session.execute(text("SELECT 1 UNION ALL SELECT 2"),
+                                 execution_options={'yield_per': 1})
+        # never iterated
+        rows = ResultStream(result)
+        self.assertFalse(rows.closed)
+        del rows
+        self.assertTrue(result.closed)
+        session.close()
+        engine.dispose()
+
+
+class ConnectionBudgetTests(unittest.TestCase):
+    """Waiting checkouts get connections in turn."""
+
+    def setUp(self):
+        self.budget = ConnectionBudget(limit=1)
+        self.budget.acquire()
+
+    def _wait(self, waiting):
+        deadline = time.monotonic() + 5
+        while (self.budget.stats()['waiting'] < waiting
+               and time.monotonic() < deadline):
+            time.sleep(0.001)
+
+    def test_waiting_checkouts_are_served_in_order(self):
+        served = []
+
+        def checkout(i):
+            self.budget.acquire()
+            served.append(i)
+            self.budget.release()
+
+        threads = []
+        for i in range(5):
+            thread = threading.Thread(target=checkout, args=(i, ))
+            thread.start()
+            threads.append(thread)
+            self._wait(i + 1)
+        self.budget.release()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(served, [0, 1, 2, 3, 4])
+        self.assertEqual(self.budget.stats()['in_use'], 0)
+
+    def test_raising_the_limit_lets_waiting_checkouts_in(self):
+        thread = threading.Thread(target=self.budget.acquire)
+        thread.start()
+        self._wait(1)
+        self.budget.configure(limit=2)
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(self.budget.stats()['in_use'], 2)
+
+    def test_timeout(self):
+        self.budget.configure(limit=1, timeout=0.01)
+        with self.assertRaises(ConnectionBudgetTimeout):
+            self.budget.acquire()
+        stats = self.budget.stats()
+        self.assertEqual((stats['in_use'], stats['waiting'],
+                          stats['timeouts']), (1, 0, 1))
+
+
+class FakeCursor:
+
+    def __init__(self):
+        self.statements = []
+
+    def execute(self, statement):
+        self.statements.append(statement)
+
+    def close(self):
+        pass
+
+
+class FakeDialect:
+
+    def __init__(self, name, is_mariadb=False):
+        self.name = name
+        self.is_mariadb = is_mariadb
+
+
+class FakeDBAPIConnection:
+
+    def __init__(self):
+        self.cursors = []
+
+    def cursor(self):
+        cursor = FakeCursor()
+        self.cursors.append(cursor)
+        return cursor
+
+
+class FakeConnection:
+
+    def __init__(self, dialect):
+        self.dialect = dialect
+        self.info = {}
+        # the pooled connection, which here is its own DBAPI connection
+        self.connection = self
+        self.dbapi_connection = FakeDBAPIConnection()
+
+
+class FakeConnectionRecord:
+
+    def __init__(self, info):
+        self.info = info
+
+
+class FakeExecutionContext:
+    execution_options = {_DEADLINES: True}
+
+
+class DeadlineTests(unittest.TestCase):
+    """The time left becomes a statement timeout of the database."""
+
+    def _execute(self, dialect, seconds):
+        conn = FakeConnection(dialect)
+        cursor = FakeCursor()
+        with deadline(seconds):
+            _before(conn, cursor, "SELECT 1", (), FakeExecutionContext(),
+                    False)
+        _before(conn, cursor, "SELECT 1", (), FakeExecutionContext(), False)
+        _before(conn, cursor, "SELECT 1", (), FakeExecutionContext(), False)
+        # a server side cursor of the statement can't run them
+        self.assertEqual(cursor.statements, [])
+        return [statement for setting in conn.dbapi_connection.cursors
+                for statement in setting.statements]
+
+    def _assertStatements(self, statements, expected):
+        self.assertEqual(len(statements), len(expected))
+        for statement, pattern in zip(statements, expected):
+            self.assertRegex(statement, pattern)
+
+    def test_postgresql(self):
+        self._assertStatements(
+            self._execute(FakeDialect('postgresql'), 5),
+            [r"^SET LOCAL statement_timeout = (49\d\d|5000)$",
+             r"^SET LOCAL statement_timeout = DEFAULT$"])
+
+    def test_mysql(self):
+        self._assertStatements(
+            self._execute(FakeDialect('mysql'), 5),
+            [r"^SET SESSION max_execution_time = (49\d\d|5000)$",
+             r"^SET SESSION max_execution_time = DEFAULT$"])
+
+    def test_mysql_timeout_is_reset_on_checkin(self):
+        conn = FakeConnection(FakeDialect('mysql'))
+        with deadline(5):
+            _before(conn, FakeCursor(), "SELECT 1", (),
+                    FakeExecutionContext(), False)
+        _checkin(conn.dbapi_connection, FakeConnectionRecord(conn.info))
+        self.assertEqual(conn.dbapi_connection.cursors[-1].statements,
+                         ["SET SESSION max_execution_time = DEFAULT"])
+        self.assertEqual(conn.info, {})
+
+    def test_timeout_is_reset_for_other_statements(self):
+        conn = FakeConnection(FakeDialect('postgresql'))
+        cursor = FakeCursor()
+        with deadline(5):
+            _before(conn, cursor, "SELECT 1", (), FakeExecutionContext(),
+                    False)
+            # a statement without the option, of another session
+            _before(conn, cursor, "SELECT 1", (), None, False)
+        self.assertEqual(conn.dbapi_connection.cursors[-1].statements,
+                         ["SET LOCAL statement_timeout = DEFAULT"])
+
+    def test_sqlite_timeout_does_not_outlive_the_session(self):
+        engine = create_engine('sqlite://', poolclass=QueuePool,
+                               pool_size=1)
+        maker = sessionmaker(bind=engine)
+        enforce_deadlines(maker)
+        session = maker()
+        with deadline(0.05):
+            session.execute(text("SELECT 1"))
+        session.close()
+        time.sleep(0.1)
+        # the same database connection, used without deadlines
+        with engine.connect() as connection:
+            self.assertEqual(connection.execute(text(
+                "WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 "
+                "FROM c WHERE x < 10000) SELECT count(*) FROM c")).scalar(),
+                10000)
+        engine.dispose()
+
+    def test_sharing_connections_is_refused(self):
+        with self.assertRaises(ValueError):
+            GloballyScopedSession(deadlines=True, share_connection=True)
+
+    def test_mariadb(self):
+        self._assertStatements(
+            self._execute(FakeDialect('mysql', is_mariadb=True), 5),
+            [r"^SET SESSION max_statement_time = (4\.9\d\d|5\.000)$",
+             r"^SET SESSION max_statement_time = DEFAULT$"])
+
+
+class SharedStatsFileTests(unittest.TestCase):
+    """Slots of the shared pool statistics file."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.stats_file = SharedStatsFile(os.path.join(self.tmp, 'pools'),
+                                          slots=2)
+
+    def tearDown(self):
+        self.stats_file.close()
+        shutil.rmtree(self.tmp)
+
+    def test_long_names_are_shortened_to_whole_characters(self):
+        name = 'x' + '\xfc' * 40
+        slot = self.stats_file.claim(name)
+        self.stats_file.write(slot, (1, 0, 0, 1, 0, 0.0))
+        [(pid, read_name, values)] = self.stats_file.read()
+        self.assertTrue(name.startswith(read_name))
+        self.assertLessEqual(len(read_name.encode('utf-8')), 64)
+        self.assertEqual(values['open_connections'], 1)
+
+
+class ImportTimeTests(unittest.TestCase):
+    """Importing z3c.saconfig stays cheap for processes without a database.
+    """
+
+    # microseconds; importing SQLAlchemy takes several hundred milliseconds
+    budget = 50000
+
+    def _importTime(self, module):
+        # a new interpreter, as this one has imported everything already
+        process = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+            stderr=subprocess.PIPE, universal_newlines=True, check=True)
+        imported = {}
+        for line in process.stderr.splitlines():
+            if not line.startswith('import time:'):
+                continue
+            self_time, cumulative, name = line[12:].split('|')
+            if cumulative.strip().isdigit():
+                imported[name.strip()] = int(cumulative)
+        return imported
+
+    def test_package_does_not_import_sqlalchemy(self):
+        imported = self._importTime('z3c.saconfig')
+        self.assertNotIn('sqlalchemy', imported)
+        self.assertNotIn('zope.sqlalchemy', imported)
+        self.assertLess(
+            imported['z3c.saconfig'], self.budget,
+            'importing z3c.saconfig took %dus' % imported['z3c.saconfig'])
+
+    def test_engine_factories_do_not_import_the_orm(self):
+        imported = self._importTime('z3c.saconfig.utility')
+        self.assertNotIn('sqlalchemy.orm', imported)
+        self.assertNotIn('sqlalchemy.ext.asyncio', imported)
+
+
+@unittest.skipUnless(hasattr(os, 'fork'), 'needs os.fork')
+class ForkTests(unittest.TestCase):
+    """A child process doesn't use the connections of its parent."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        url = 'sqlite:///' + os.path.join(self.directory, 'fork.db')
+        self.factory = EngineFactory(url)
+        component.provideUtility(self.factory, provides=IEngineFactory,
+                                 name='fork')
+        component.provideUtility(GloballyScopedSession(engine='fork'),
+                                 provides=IScopedSession, name='fork')
+
+    def tearDown(self):
+        cleanup.cleanUp()
+        self.factory.reset()
+        shutil.rmtree(self.directory)
+
+    def _inChild(self, check):
+        """Run check in a child process, return what it returns."""
+        read, write = os.pipe()
+        pid = os.fork()
+        if pid == 0:  # pragma: no cover
+            try:
+                os.close(read)
+                os.write(write, repr(check()).encode())
+            finally:
+                os._exit(0)
+        os.close(write)
+        with os.fdopen(read) as result:
+            output = result.read()
+        os.waitpid(pid, 0)
+        return output
+
+    def test_engines_get_a_new_pool(self):
+        engine = self.factory()
+        connection = engine.connect()
+        pool = engine.pool
+
+        def check():
+            child_engine = self.factory()
+            with child_engine.connect() as child_connection:
+                child_connection.exec_driver_sql('SELECT 1')
+            return (child_engine is engine, child_engine.pool is pool,
+                    pool.checkedout())
+
+        self.assertEqual(self._inChild(check), '(True, False, 1)')
+        # the connection of the parent is untouched
+        self.assertEqual(
+            connection.exec_driver_sql('SELECT 1').scalar(), 1)
+        connection.close()
+
+    def test_sessions_are_not_inherited(self):
+        Session = named_scoped_session('fork')
+        session = Session()
+
+        def check():
+            return (Session() is session, session in _INHERITED)
+
+        self.assertEqual(self._inChild(check), '(False, True)')
+        self.assertIs(Session(), session)
+        Session.remove()
+
+    def test_workers_share_pool_statistics(self):
+        url = 'sqlite:///' + os.path.join(self.directory, 'stats.db')
+        factory = EngineFactory(url, instrument=True, poolclass=QueuePool)
+        component.provideUtility(factory, provides=IEngineFactory,
+                                 name='workers')
+        path = os.path.join(self.directory, 'pools')
+        export_pool_stats(path, names=['workers'])
+        connection = factory().connect()
+
+        def check():
+            with factory().connect():
+                totals = shared_pool_stats(path)['workers']
+            return totals['processes'], totals['checked_out']
+
+        try:
+            self.assertEqual(self._inChild(check), '(2, 2)')
+            # the slot of the child is free again
+            self.assertEqual(shared_pool_stats(path)['workers']['processes'],
+                             1)
+        finally:
+            connection.close()
+            factory.reset()
+
+
 def test_suite():
     optionflags = doctest.NORMALIZE_WHITESPACE | doctest.ELLIPSIS
     globs = {
@@ -130,4 +755,24 @@ def test_suite():
         setUp=setUpReadMe,
         tearDown=tearDownReadMe,
         globs=globs))
+    suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(
+        EngineWarmUpTests))
+    suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(
+        SessionRegistryTests))
+    suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(
+        ScopeTests))
+    suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(
+        FailoverTests))
+    suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(
+        ResultStreamTests))
+    suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(
+        ConnectionBudgetTests))
+    suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(
+        DeadlineTests))
+    suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(
+        SharedStatsFileTests))
+    suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(
+        ForkTests))
+    suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(
+        ImportTimeTests))
     return suite
@@ -1,22 +1,44 @@
 """
 Some reusable, standard implementations of IScopedSession.
 """
+import functools
+import itertools
+import logging
+import os
+import sys
 import threading
 import time
-from threading import get_ident
 
 import sqlalchemy
-from zope import component
+from sqlalchemy import event
+from sqlalchemy.exc import DisconnectionError
+from sqlalchemy.pool import NullPool
 from zope.event import notify
 from zope.interface import implementer
-from zope.sqlalchemy import register
+from zope.interface import implementer_only
 
+from z3c.saconfig.budget import ConnectionBudget
+from z3c.saconfig.interfaces import CircuitStateChangedEvent
 from z3c.saconfig.interfaces import EngineCreatedEvent
+from z3c.saconfig.interfaces import EngineWarmedUpEvent
+from z3c.saconfig.interfaces import IAsyncEngineFactory
+from z3c.saconfig.interfaces import IAsyncScopedSession
 from z3c.saconfig.interfaces import IEngineFactory
+from z3c.saconfig.interfaces import IRoutingEngineFactory
 from z3c.saconfig.interfaces import IScopedSession
 from z3c.saconfig.interfaces import ISiteScopedSession
+from z3c.saconfig.interfaces import ITenantEngineFactory
+from z3c.saconfig.lookup import get_utility
+from z3c.saconfig.profiling import profile_session
+from z3c.saconfig.registry import EngineRegistry
+from z3c.saconfig.registry import checked_out
+from z3c.saconfig.scopes import THREAD
+from z3c.saconfig.scopes import get_scope
+from z3c.saconfig.stats import PoolStats
 
 
+logger = logging.getLogger('z3c.saconfig')
+
 SESSION_DEFAULTS = dict(
     autocommit=False,
     autoflush=True,
@@ -36,18 +58,47 @@ class GloballyScopedSession:
     to pass the right arguments to the superclasses __init__.
     """
 
-    def __init__(self, engine='', **kw):
-        """Pass keywords arguments for sqlalchemy.orm.create_session.
+    profile = False
+    slow_threshold = None
+    cache = None
+    share_connection = False
+    deadlines = False
+    scope = THREAD
+
+    def __init__(self, engine='', *, profile=False, slow_threshold=None,
+                 cache_size=None, cache_ttl=None, share_connection=False,
+                 deadlines=False, scope='thread', **kw):
+        """Pass keywords arguments for sqlalchemy.orm.sessionmaker.
 
         The `engine` argument is the name of a utility implementing
         IEngineFactory.
 
+        With `profile`, the statements executed by the sessions are timed,
+        see z3c.saconfig.profiling. Statements taking more than
+        `slow_threshold` seconds are logged; this implies `profile`.
+
+        With `cache_size` or `cache_ttl`, objects loaded by the sessions are
+        kept in an IdentityCache of that many objects (1000 by default),
+        for that many seconds (60 by default), see z3c.saconfig.cache.
+
+        With `share_connection`, sessions of this and other utilities with
+        that option share a connection per engine within a Zope
+        transaction, see z3c.saconfig.shared.
+
+        With `deadlines`, statements of the sessions are cancelled at the
+        deadline of the current request, see z3c.saconfig.deadline. The
+        sessions then can't share connections.
+
+        `scope` selects the unit of concurrency that gets its own session:
+        'thread', 'greenlet' or 'context', see z3c.saconfig.scopes.
+
         Note that GloballyScopedSesssion does have different defaults than
-        ``create_session`` for various parameters where it makes sense
+        ``sessionmaker`` for various parameters where it makes sense
         for Zope integration, namely:
 
         autocommit = False
         autoflush = True
+        expire_on_commit = False
         extension = ZopeTransactionExtension()
 
         Normally you wouldn't pass these in, but if you have the need
@@ -55,19 +106,21 @@ class GloballyScopedSession:
         """
         self.engine = engine
         self.kw = _zope_session_defaults(kw)
+        self.profile = profile or slow_threshold is not None
+        self.slow_threshold = slow_threshold
+        self.cache = _identity_cache(cache_size, cache_ttl)
+        self.share_connection = share_connection
+        self.deadlines = _deadlines(deadlines, share_connection)
+        self.scope = get_scope(scope)
 
     def sessionFactory(self):
-        kw = self.kw.copy()
-        if 'bind' not in kw:
-            engine_factory = component.getUtility(IEngineFactory,
-                                                  name=self.engine)
-            kw['bind'] = engine_factory()
-        session = sqlalchemy.orm.create_session(**kw)
-        register(session)
-        return session
+        if 'bind' in self.kw:
+            return _session_maker(self)()
+        engine_factory = get_utility(IEngineFactory, self.engine)
+        return _create_session(self, engine_factory)
 
     def scopeFunc(self):
-        return get_ident()
+        return self.scope.ident()
 
 
 def _zope_session_defaults(kw):
@@ -80,6 +133,84 @@ def _zope_session_defaults(kw):
     return d
 
 
+def _deadlines(deadlines, share_connection):
+    if deadlines and share_connection:
+        # the deadline would apply to the other sessions of the connection
+        raise ValueError(
+            "Sessions with deadlines can't share connections")
+    return deadlines
+
+
+def _identity_cache(cache_size, cache_ttl):
+    if cache_size is None and cache_ttl is None:
+        return None
+    from z3c.saconfig.cache import DEFAULT_TTL
+    from z3c.saconfig.cache import IdentityCache
+    if cache_ttl is None:
+        # changes made elsewhere must show up eventually
+        cache_ttl = DEFAULT_TTL
+    if cache_size is None:
+        return IdentityCache(ttl=cache_ttl)
+    return IdentityCache(cache_size, cache_ttl)
+
+
+def _create_session(utility, engine_factory):
+    """Create a session using the engine(s) of an IEngineFactory.
+    """
+    if IRoutingEngineFactory.providedBy(engine_factory):
+        return _session_maker(utility, routing=True)(router=engine_factory)
+    return _session_maker(utility)(engine_factory=engine_factory)
+
+
+def _session_maker(utility, routing=False):
+    """Get the sessionmaker of a scoped session utility.
+
+    With ``routing``, it makes RoutingSession objects instead of
+    FactorySession objects.
+
+    The sessionmaker is built once with the keyword arguments of the
+    utility, and has the Zope transaction, profiling, caching and deadlines
+    set up, so that creating a session is a single call. The engine
+    factory is passed on each call, as it depends on the engine factory
+    utility in effect; the sessions ask it for the engine of each
+    transaction.
+    """
+    makers = getattr(utility, '_v_sessionmakers', None)
+    if makers is None:
+        makers = utility._v_sessionmakers = {}
+    maker = makers.get(routing)
+    if maker is None:
+        # the ORM is imported once sessions are needed, not at startup
+        from sqlalchemy.orm import sessionmaker
+        from zope.sqlalchemy import register
+
+        from z3c.saconfig.cache import caching_session_class
+        from z3c.saconfig.deadline import enforce_deadlines
+        from z3c.saconfig.session import FactorySession
+        from z3c.saconfig.session import RoutingSession
+        from z3c.saconfig.shared import sharing_session_class
+        class_ = RoutingSession if routing else FactorySession
+        kw = utility.kw.copy()
+        # the default of the create_session function used before
+        kw.setdefault('expire_on_commit', False)
+        session_class = class_
+        if utility.cache is not None:
+            session_class = caching_session_class(class_, utility.cache)
+        if utility.share_connection:
+            # the shared connection commits, with two-phase if asked for
+            session_class = sharing_session_class(
+                session_class, kw.pop('twophase', False))
+        maker = sessionmaker(class_=session_class, **kw)
+        if utility.profile:
+            profile_session(maker, utility.slow_threshold)
+        if utility.deadlines:
+            enforce_deadlines(maker)
+        register(maker)
+        # concurrent callers may each build one; the last one is kept
+        makers[routing] = maker
+    return maker
+
+
 @implementer(ISiteScopedSession)
 class SiteScopedSession:
     """A session that is scoped per site.
@@ -92,34 +223,209 @@ class SiteScopedSession:
     a SiteScopedSession utility without passing parameters to its constructor.
     """
 
-    def __init__(self, engine='', **kw):
+    profile = False
+    slow_threshold = None
+    cache = None
+    share_connection = False
+    deadlines = False
+    scope = THREAD
+
+    def __init__(self, engine='', *, profile=False, slow_threshold=None,
+                 cache_size=None, cache_ttl=None, share_connection=False,
+                 deadlines=False, scope='thread', **kw):
         assert 'bind' not in kw
         self.engine = engine
         self.kw = _zope_session_defaults(kw)
+        self.profile = profile or slow_threshold is not None
+        self.slow_threshold = slow_threshold
+        self.cache = _identity_cache(cache_size, cache_ttl)
+        self.share_connection = share_connection
+        self.deadlines = _deadlines(deadlines, share_connection)
+        self.scope = get_scope(scope)
 
     def sessionFactory(self):
-        engine_factory = component.getUtility(IEngineFactory,
-                                              name=self.engine)
-        kw = self.kw.copy()
-        kw['bind'] = engine_factory()
-        session = sqlalchemy.orm.create_session(**kw)
-        register(session)
-        return session
+        engine_factory = get_utility(IEngineFactory, self.engine)
+        return _create_session(self, engine_factory)
 
     def scopeFunc(self):
-        return (get_ident(), self.siteScopeFunc())
+        return (self.scope.ident(), self.siteScopeFunc())
 
     def siteScopeFunc(self):
         raise NotImplementedError
 
+
+class TenantScopedSession(SiteScopedSession):
+    """A site scoped session for sites that are tenants of one database.
+
+    With a TenantEngineFactory, usually registered globally, the sessions
+    of all sites share one engine and its pool, so the number of database
+    connections does not grow with the number of sites. Each site keeps
+    its tables in the schema returned by ``tenantSchema``.
+
+    Other engine factories are used as by SiteScopedSession.
+    """
+
+    def sessionFactory(self):
+        engine_factory = get_utility(IEngineFactory, self.engine)
+        if not ITenantEngineFactory.providedBy(engine_factory):
+            return _create_session(self, engine_factory)
+        return _session_maker(self)(engine_factory=functools.partial(
+            engine_factory.tenant, self.tenantSchema()))
+
+    def tenantSchema(self):
+        """Return the schema of the current site.
+
+        This is the site scope by default, which then has to be a string.
+        """
+        return self.siteScopeFunc()
+
+
+@implementer(IAsyncScopedSession)
+class AsyncScopedSession:
+    """An asyncio session that is scoped per task.
+
+    Use this with ``named_async_scoped_session``. Creation arguments are
+    as for GloballyScopedSession, except that ``engine`` names an
+    IAsyncEngineFactory utility, and that the keyword arguments are
+    passed to ``sqlalchemy.ext.asyncio.AsyncSession``.
+
+    The sessions are not joined to the Zope transaction; use ``await
+    session.commit()`` to commit them. Call ``await Session.remove()``
+    when a task is done with its session.
+    """
+
+    def __init__(self, engine='', **kw):
+        self.engine = engine
+        self.kw = _zope_session_defaults(kw)
+        # as for the other utilities
+        self.kw.setdefault('expire_on_commit', False)
+
+    def sessionFactory(self):
+        kw = self.kw.copy()
+        if 'bind' not in kw:
+            engine_factory = get_utility(IAsyncEngineFactory, self.engine)
+            kw['bind'] = engine_factory()
+        # sqlalchemy.ext.asyncio is slow to import, load it when used
+        from sqlalchemy.ext.asyncio import AsyncSession
+        return AsyncSession(**kw)
+
+    def scopeFunc(self):
+        # imported already when there is a task, but not at startup
+        import asyncio
+        return asyncio.current_task()
+
 # Credits: This method of storing engines lifted from zope.app.cache.ram
 
 
 _COUNTER = 0
 _COUNTER_LOCK = threading.Lock()
 
-_ENGINES = {}
+_ENGINES = EngineRegistry()
+# guards _ENGINE_LOCKS only; engines are created holding the lock of their
+# key, so that unrelated engines can be created at the same time
 _ENGINES_LOCK = threading.Lock()
+_ENGINE_LOCKS = {}
+# the process the engines are for
+_PID = os.getpid()
+# connections that the engines created from now on can check out together
+_BUDGET = ConnectionBudget()
+
+
+def _engineLock(key):
+    """Get the lock serializing creation and reset of the engine for key.
+    """
+    lock = _ENGINE_LOCKS.get(key)
+    if lock is None:
+        _ENGINES_LOCK.acquire()
+        try:
+            lock = _ENGINE_LOCKS.setdefault(key, threading.Lock())
+        finally:
+            _ENGINES_LOCK.release()
+    return lock
+
+
+def configure_engine_cache(maxsize=None, idle_ttl=None):
+    """Bound the number of engines kept by all engine factories.
+
+    ``maxsize`` is the maximum number of engines; the least recently used
+    ones are evicted beyond that. ``idle_ttl`` evicts engines that were not
+    used for that many seconds. Evicted engines are disposed once their
+    connections are checked in. None means no limit.
+    """
+    _ENGINES.configure(maxsize, idle_ttl)
+
+
+def engine_cache_stats():
+    """Return the hits, misses and evictions of the engine cache.
+
+    The dictionary also has the current ``size``, and the number of
+    evicted engines that still wait for connections to be checked in
+    (``retired``).
+    """
+    return _ENGINES.stats()
+
+
+def configure_connection_budget(limit=None, timeout=None):
+    """Limit the connections checked out of all engines together.
+
+    Engines created by engine factories from now on take a connection of
+    the budget of ``limit`` connections for each checkout. Once all are
+    in use, checkouts wait for one in turn, for at most ``timeout``
+    seconds, and then raise ConnectionBudgetTimeout. None means no limit,
+    or no timeout.
+    """
+    _BUDGET.configure(limit, timeout)
+
+
+def connection_budget_stats():
+    """Return the state and counters of the connection budget.
+
+    The dictionary has the ``limit``, the connections ``in_use`` and the
+    checkouts ``waiting`` for one, and counts the ``checkouts``, those
+    that had to wait (``waits``), the total ``wait_time`` and the
+    ``timeouts``.
+    """
+    return _BUDGET.stats()
+
+
+def after_fork():
+    """Make engines and sessions of a parent process safe to use.
+
+    Engines get new pools, without closing the connections of their old
+    ones, which the parent process still uses. Sessions created in the
+    parent process are forgotten. This happens automatically in child
+    processes created with ``os.fork``; call it yourself after other
+    ways of forking. It does nothing if the process didn't change.
+    """
+    global _PID, _COUNTER_LOCK, _ENGINES_LOCK, _ENGINE_LOCKS
+    if os.getpid() == _PID:
+        return
+    _PID = os.getpid()
+    # other threads may have held these when the process forked
+    _COUNTER_LOCK = threading.Lock()
+    _ENGINES_LOCK = threading.Lock()
+    _ENGINE_LOCKS = {}
+    _ENGINES.forked()
+    _BUDGET.forked()
+    # without it, there are no sessions yet
+    scopedsession = sys.modules.get('z3c.saconfig.scopedsession')
+    if scopedsession is not None:
+        scopedsession.forget_sessions()
+
+
+if hasattr(os, 'register_at_fork'):
+    # not on Windows, which doesn't fork
+    os.register_at_fork(after_in_child=after_fork)
+
+
+try:
+    from zope.testing.cleanup import addCleanUp
+except ImportError:  # pragma: no cover
+    pass
+else:
+    addCleanUp(configure_engine_cache)
+    addCleanUp(configure_connection_budget)
+    addCleanUp(lambda: _TENANT_STATS.clear())
 
 
 @implementer(IEngineFactory)
@@ -137,10 +443,20 @@ class EngineFactory:
     schema). In this case you need to override the configuration method.
     """
 
-    def __init__(self, *args, **kw):
+    stats = None
+
+    def __init__(self, *args, instrument=False, **kw):
+        """Pass the arguments for ``sqlalchemy.create_engine``.
+
+        With ``instrument``, statistics about the connection pools of the
+        engines are collected in the ``stats`` attribute, a
+        ``z3c.saconfig.stats.PoolStats`` object.
+        """
         self._args = args
         self._kw = kw
         self._key = self._getKey()
+        if instrument:
+            self.stats = PoolStats()
 
     def _getKey(self):
         """Get a unique key"""
@@ -154,21 +470,24 @@ class EngineFactory:
 
     def __call__(self):
         # optimistically try get without lock
-        engine = _ENGINES.get(self._key, None)
+        engine = _ENGINES.get(self._key)
         if engine is not None:
             return engine
-        # no engine, lock and redo
-        _ENGINES_LOCK.acquire()
+        # no engine, lock and redo. Concurrent callers for this key wait
+        # for a single engine to be built.
+        lock = _engineLock(self._key)
+        lock.acquire()
         try:
             # need to check, another thread may have got there first
-            if self._key not in _ENGINES:
+            engine = _ENGINES.get(self._key)
+            if engine is None:
                 args, kw = self.configuration()
-                _ENGINES[self._key] = engine = sqlalchemy.create_engine(
-                    *args, **kw)
+                engine = self._newEngine(args, kw)
+                _ENGINES.add(self._key, engine, self._disposeEngine)
                 notify(EngineCreatedEvent(engine, args, kw))
-            return _ENGINES[self._key]
+            return engine
         finally:
-            _ENGINES_LOCK.release()
+            lock.release()
 
     def configuration(self):
         """Returns engine parameters.
@@ -179,12 +498,479 @@ class EngineFactory:
         return self._args, self._kw
 
     def reset(self):
-        _ENGINES_LOCK.acquire()
+        """Drop the engine; the next call creates a new one.
+
+        The engine is disposed once the connections that are checked out
+        are returned, so requests using it can finish.
+        """
+        lock = _engineLock(self._key)
+        lock.acquire()
+        try:
+            _ENGINES.retire(self._key)
+        finally:
+            lock.release()
+
+    def reconfigure(self, *args, prefill=0, background=False, **kw):
+        """Change the arguments for ``sqlalchemy.create_engine``.
+
+        Positional arguments, the URL, replace the current ones if given;
+        keyword arguments are added to the current ones. If the factory
+        has an engine, a new one is created with the new arguments and
+        replaces it for the next transactions of sessions, after
+        ``prefill`` connections were opened. The old engine is disposed
+        once its connections that are checked out are returned, so
+        requests using it can finish.
+
+        With ``background``, the new engine is created in a daemon thread,
+        which is returned. Failures are logged there instead of being
+        raised. If the new engine can't be created or prefilled, the old
+        arguments and engine are kept.
+        """
+        args = args or self._args
+        kw = dict(self._kw, **kw)
+        if not background:
+            return self._swap(args, kw, prefill)
+        thread = threading.Thread(
+            target=self._swapInBackground, args=(args, kw, prefill),
+            name='z3c.saconfig reconfigure', daemon=True)
+        thread.start()
+        return thread
+
+    def _swapInBackground(self, args, kw, prefill):
+        try:
+            self._swap(args, kw, prefill)
+        except Exception:
+            logger.exception("Could not reconfigure engine %s", self._key)
+
+    def _swap(self, args, kw, prefill):
+        if self._key not in _ENGINES:
+            # created with the new arguments when it is needed
+            self._args, self._kw = args, kw
+            return
+        # not holding the lock, lookups get the old engine meanwhile
+        engine = self._newEngine(args, kw)
+        if prefill:
+            try:
+                _prefill(engine, prefill)
+            except BaseException:
+                self._disposeEngine(engine)
+                raise
+        lock = _engineLock(self._key)
+        lock.acquire()
+        try:
+            # only now that the engine works
+            self._args, self._kw = args, kw
+            _ENGINES.replace(self._key, engine, self._disposeEngine)
+        finally:
+            lock.release()
+        notify(EngineCreatedEvent(engine, args, kw))
+
+    def warmup(self, prefill=0, background=False):
+        """Create the engine and open pool connections ahead of use.
+
+        ``prefill`` connections are opened at the same time and then
+        checked in, so that they stay in the pool; more than the pool
+        size are not opened. An IEngineWarmedUpEvent is fired when done.
+
+        With ``background``, this happens in a daemon thread, which is
+        returned. Failures are logged there instead of being raised.
+        """
+        if not background:
+            return self._warmup(prefill)
+        thread = threading.Thread(
+            target=self._warmupInBackground, args=(prefill, ),
+            name='z3c.saconfig warmup', daemon=True)
+        thread.start()
+        return thread
+
+    def _warmupInBackground(self, prefill):
+        try:
+            self._warmup(prefill)
+        except Exception:
+            logger.exception("Could not warm up engine %s", self._key)
+
+    def _warmup(self, prefill):
+        engine = self()
+        notify(EngineWarmedUpEvent(engine, _prefill(engine, prefill)))
+
+    def _newEngine(self, args, kw):
+        engine = self._createEngine(args, kw)
+        if self.stats is not None:
+            self.stats.attach(engine)
+        if _BUDGET.limit is not None:
+            self._budget(engine)
+        return engine
+
+    def _createEngine(self, args, kw):
+        return sqlalchemy.create_engine(*args, **kw)
+
+    def _budget(self, engine):
+        _BUDGET.attach(engine)
+
+    def _disposeEngine(self, engine):
+        engine.dispose()
+
+
+def _prefill(engine, prefill):
+    """Open connections of an engine and check them in to its pool.
+
+    Returns the number of connections, no more than the pool size.
+    """
+    size = getattr(engine.pool, 'size', None)
+    # not all pool classes have a size
+    if callable(size):
+        prefill = min(prefill, size())
+    connections = []
+    try:
+        for i in range(prefill):
+            connections.append(engine.raw_connection())
+    finally:
+        for connection in connections:
+            connection.close()
+    return len(connections)
+
+
+@implementer_only(IAsyncEngineFactory)
+class AsyncEngineFactory(EngineFactory):
+    """An engine factory for asyncio engines.
+
+    Takes the arguments of ``sqlalchemy.ext.asyncio.create_async_engine``,
+    and otherwise behaves like EngineFactory.
+
+    ``reset`` cannot wait for connections to be closed, so it just lets
+    go of the pool. Call ``await factory().dispose()`` before resetting
+    the factory to close the connections properly.
+
+    It provides IAsyncEngineFactory only, not IEngineFactory, so that
+    lookups for ordinary engines never return an asyncio one.
+
+    ``warmup`` raises TypeError, as connecting needs an event loop; for
+    the same reason ``reconfigure`` cannot prefill the new engine. The
+    connection budget doesn't apply to asyncio engines.
+    """
+
+    def _createEngine(self, args, kw):
+        from sqlalchemy.ext.asyncio import create_async_engine
+        return create_async_engine(*args, **kw)
+
+    def _disposeEngine(self, engine):
+        engine.sync_engine.dispose(close=False)
+
+    def _budget(self, engine):
+        # waiting for the budget would block the event loop
+        pass
+
+    def warmup(self, prefill=0, background=False):
+        """Not supported for asyncio engines, raises TypeError.
+        """
+        raise TypeError(
+            "asyncio engines cannot be warmed up from synchronous code")
+
+
+ROUND_ROBIN = 'round-robin'
+LEAST_CHECKED_OUT = 'least-checked-out'
+REPLICA_POLICIES = (ROUND_ROBIN, LEAST_CHECKED_OUT)
+
+
+@implementer(IRoutingEngineFactory)
+class RoutingEngineFactory(EngineFactory):
+    """An engine factory for a primary database with read replicas.
+
+    Calling the factory returns the primary engine, just like
+    EngineFactory. Sessions created by GloballyScopedSession and
+    SiteScopedSession for this factory send flushes and data changing
+    statements to the primary and other statements to a replica.
+
+    ``replicas`` is a sequence of database URLs; all other keyword
+    arguments are used for the primary and the replica engines alike.
+    ``policy`` selects the replica: ``round-robin`` takes turns,
+    ``least-checked-out`` picks the one whose pool has the fewest
+    connections in use.
+    """
+
+    def __init__(self, url, replicas=(), policy=ROUND_ROBIN, **kw):
+        if policy not in REPLICA_POLICIES:
+            raise ValueError("Unknown replica policy: %r" % policy)
+        super().__init__(url, **kw)
+        self.policy = policy
+        self._replicas = [EngineFactory(replica, **kw)
+                          for replica in replicas]
+        self._turn = itertools.count()
+
+    def replica(self):
+        if not self._replicas:
+            return self()
+        if self.policy == LEAST_CHECKED_OUT:
+            return min((factory() for factory in self._replicas),
+                       key=checked_out)
+        index = next(self._turn) % len(self._replicas)
+        return self._replicas[index]()
+
+    def reset(self):
+        super().reset()
+        for factory in self._replicas:
+            factory.reset()
+
+    def reconfigure(self, *args, prefill=0, background=False, **kw):
+        """Change the arguments of the engines.
+
+        Positional arguments, the URL, apply to the primary; keyword
+        arguments to the primary and the replicas. With ``background``,
+        the thread swapping the primary engine is returned.
+        """
+        for factory in self._replicas:
+            factory.reconfigure(prefill=prefill, background=background, **kw)
+        return super().reconfigure(
+            *args, prefill=prefill, background=background, **kw)
+
+
+@implementer(ITenantEngineFactory)
+class TenantEngineFactory(EngineFactory):
+    """An engine factory sharing its engine with the other tenants.
+
+    All TenantEngineFactory objects with the same arguments share one
+    engine and one pool, instead of each having its own, so resetting
+    one of them resets all. ``tenant`` returns an engine that puts tables
+    without a schema into the schema of a tenant, using SQLAlchemy's
+    ``schema_translate_map`` execution option, and otherwise shares the
+    pool of the engine.
+
+    ``schema`` makes calling the factory return the engine of that
+    tenant. Use it for a factory registered as a local utility of a site.
+
+    With ``instrument``, which is part of the configuration, the factories
+    sharing an engine share its ``stats`` too. As the configuration is
+    shared, ``reconfigure`` raises TypeError; create factories with the
+    new arguments instead.
+    """
+
+    def __init__(self, *args, schema=None, instrument=False, **kw):
+        self._instrument = instrument
+        super().__init__(*args, instrument=instrument, **kw)
+        if instrument:
+            self.stats = _TENANT_STATS.setdefault(self._key, self.stats)
+        self.schema = schema
+        self._tenants = {}
+
+    def _getKey(self):
+        """Get a key shared by factories with the same configuration"""
+        return "tenant_%r_%r_%r" % (
+            self._args, sorted(self._kw.items()), self._instrument)
+
+    def reconfigure(self, *args, prefill=0, background=False, **kw):
+        """Not supported for shared engines, raises TypeError.
+        """
+        # the other factories sharing the engine would recreate it with
+        # their own arguments
+        raise TypeError(
+            "the engines of tenant engine factories cannot be reconfigured")
+
+    def __call__(self):
+        engine = super().__call__()
+        if self.schema is None:
+            return engine
+        return self._tenant(engine, self.schema)
+
+    def tenant(self, schema):
+        return self._tenant(super().__call__(), schema)
+
+    def reset(self):
+        super().reset()
+        self._tenants.clear()
+
+    def _tenant(self, engine, schema):
+        cached = self._tenants.get(schema)
+        # the engine changes when a factory sharing it is reset
+        if cached is None or cached[0] is not engine:
+            tenant_engine = engine.execution_options(
+                schema_translate_map={None: schema})
+            cached = self._tenants[schema] = (engine, tenant_engine)
+        return cached[1]
+
+
+# the statistics of the instrumented engines of tenant engine factories
+_TENANT_STATS = {}
+
+
+CLOSED = 'closed'
+OPEN = 'open'
+
+
+class CircuitOpenError(DisconnectionError):
+    """None of the databases of a FailoverEngineFactory is available."""
+
+
+class FailoverEngineFactory(EngineFactory):
+    """An engine factory failing over between databases.
+
+    ``urls`` are the URLs of the databases, in order of preference; all
+    other keyword arguments are used for each of them. Calling the
+    factory returns the engine of the database in use, the first one to
+    begin with.
+
+    After ``failure_threshold`` consecutive failures to connect to the
+    database in use, the circuit breaker opens: calling the factory then
+    raises CircuitOpenError right away, instead of letting every request
+    wait for its connection to fail. The next probe tries the databases
+    in order and closes the circuit again with a new engine for the first
+    one that can be connected to. The old engine is disposed once its
+    connections are checked in. Sessions of scoped session utilities get
+    the engine from the factory for each transaction, so they follow
+    both changes. Each change fires an ICircuitStateChangedEvent.
+
+    Probes run every ``probe_interval`` seconds in a background thread,
+    started when the factory is first called. While the circuit is
+    closed they count as connection attempts to the database in use.
+    With ``probe_interval`` set to None, call ``probe`` yourself.
+    """
+
+    def __init__(self, urls, failure_threshold=3, probe_interval=5.0,
+                 **kw):
+        if not urls:
+            raise ValueError("At least one database URL is needed")
+        super().__init__(urls[0], **kw)
+        self.urls = tuple(urls)
+        self.failure_threshold = failure_threshold
+        self.probe_interval = probe_interval
+        self.state = CLOSED
+        self._failures = 0
+        self._stateLock = threading.Lock()
+        self._probeEngines = {}
+        # the process probing, threads don't survive a fork
+        self._probing = None
+        self._stopProbing = None
+
+    @property
+    def url(self):
+        """The URL of the database in use."""
+        return self._args[0]
+
+    def __call__(self):
+        if self.state == OPEN:
+            raise CircuitOpenError(
+                "None of the databases %s is available" % (self.urls, ))
+        if self._probing != _PID and self.probe_interval:
+            self._startProbing()
+        return super().__call__()
+
+    def reset(self):
+        super().reset()
+        self._stateLock.acquire()
         try:
-            if self._key not in _ENGINES:
+            stop, self._stopProbing = self._stopProbing, None
+            self._probing = None
+        finally:
+            self._stateLock.release()
+        if stop is not None:
+            stop.set()
+
+    def probe(self):
+        """Check the databases, failing over if needed.
+
+        Returns the state of the circuit breaker.
+        """
+        if self.state == CLOSED:
+            url = self.url
+            if self._alive(url):
+                self._connected(url)
+            else:
+                self._failed(url)
+            return self.state
+        for url in self.urls:
+            if self._alive(url):
+                self._close(url)
+                break
+        return self.state
+
+    def _alive(self, url):
+        engine = self._probeEngines.get(url)
+        if engine is None:
+            kw = {'poolclass': NullPool}
+            if 'connect_args' in self._kw:
+                kw['connect_args'] = self._kw['connect_args']
+            engine = self._probeEngines[url] = sqlalchemy.create_engine(
+                url, **kw)
+        try:
+            engine.connect().close()
+        except Exception:
+            return False
+        return True
+
+    def _createEngine(self, args, kw):
+        engine = super()._createEngine(args, kw)
+        url = args[0]
+
+        def handle_error(context):
+            # connect failures have no connection yet
+            if context.connection is None or context.is_disconnect:
+                self._failed(url)
+
+        def connect(dbapi_connection, connection_record):
+            self._connected(url)
+
+        event.listen(engine, 'handle_error', handle_error)
+        event.listen(engine, 'connect', connect)
+        return engine
+
+    def _connected(self, url):
+        if url == self.url:
+            self._failures = 0
+
+    def _failed(self, url):
+        self._stateLock.acquire()
+        try:
+            # failures of a database that is no longer in use don't count
+            if url != self.url or self.state == OPEN:
                 return
-            # XXX is disposing the right thing to do?
-            _ENGINES[self._key].dispose()
-            del _ENGINES[self._key]
+            self._failures += 1
+            if self._failures < self.failure_threshold:
+                return
+            self._failures = 0
+            self.state = OPEN
         finally:
-            _ENGINES_LOCK.release()
+            self._stateLock.release()
+        notify(CircuitStateChangedEvent(self, CLOSED, OPEN, url))
+
+    def _close(self, url):
+        engine = None
+        lock = _engineLock(self._key)
+        lock.acquire()
+        try:
+            self._args = (url, ) + self._args[1:]
+            if self._key in _ENGINES:
+                # the pool of the old engine may hold broken connections
+                args, kw = self.configuration()
+                engine = self._newEngine(args, kw)
+                _ENGINES.replace(self._key, engine, self._disposeEngine)
+            self._stateLock.acquire()
+            try:
+                self._failures = 0
+                self.state = CLOSED
+            finally:
+                self._stateLock.release()
+        finally:
+            lock.release()
+        notify(CircuitStateChangedEvent(self, OPEN, CLOSED, url))
+        if engine is not None:
+            notify(EngineCreatedEvent(engine, args, kw))
+
+    def _startProbing(self):
+        self._stateLock.acquire()
+        try:
+            if self._probing == _PID:
+                return
+            self._probing = _PID
+            stop = self._stopProbing = threading.Event()
+        finally:
+            self._stateLock.release()
+        thread = threading.Thread(
+            target=self._probeUntil, args=(stop, ),
+            name='z3c.saconfig probe', daemon=True)
+        thread.start()
+
+    def _probeUntil(self, stop):
+        while not stop.wait(self.probe_interval):
+            try:
+                self.probe()
+            except Exception:
+                logger.exception("Could not probe databases %s", self.urls)
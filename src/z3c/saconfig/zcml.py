@@ -1,18 +1,60 @@
 import warnings
 
 import zope.component.zcml
+import zope.configuration.fields
 import zope.interface
 import zope.schema
+from sqlalchemy import pool
 from zope.component.security import PublicPermission
+from zope.configuration.exceptions import ConfigurationError
 from zope.configuration.name import resolve
 
+from . import reload
+from . import sharedstats
+from .interfaces import IAsyncEngineFactory
+from .interfaces import IAsyncScopedSession
 from .interfaces import IEngineFactory
 from .interfaces import IScopedSession
+from .scopedsession import configure_session_cleanup
+from .utility import REPLICA_POLICIES
+from .utility import ROUND_ROBIN
+from .utility import AsyncEngineFactory
 from .utility import EngineFactory
+from .utility import FailoverEngineFactory
+from .utility import RoutingEngineFactory
+from .utility import TenantEngineFactory
+from .utility import configure_connection_budget
+from .utility import configure_engine_cache
+
+
+POOL_CLASSES = {
+    'QueuePool': pool.QueuePool,
+    'NullPool': pool.NullPool,
+    'StaticPool': pool.StaticPool,
+    'SingletonThreadPool': pool.SingletonThreadPool,
+    'AssertionPool': pool.AssertionPool,
+    'AsyncAdaptedQueuePool': pool.AsyncAdaptedQueuePool,
+}
+
+
+def _isOption(value):
+    if '=' not in value:
+        return False
+    key = value.split('=', 1)[0].strip()
+    name, _, type_ = key.partition(':')
+    return name != '' and (not type_ or type_ in _CONVERTERS)
+
+
+def _optionTokens(title, description):
+    return zope.configuration.fields.Tokens(
+        title=title,
+        description=description,
+        value_type=zope.schema.TextLine(constraint=_isOption),
+        required=False)
 
 
-class IEngineDirective(zope.interface.Interface):
-    """Registers a database engine factory."""
+class IBaseEngineDirective(zope.interface.Interface):
+    """Options shared by the engine directives."""
 
     url = zope.schema.URI(
         title='Database URL',
@@ -25,15 +67,6 @@ class IEngineDirective(zope.interface.Interface):
         required=False,
         default='')
 
-    convert_unicode = zope.schema.Bool(
-        title='Convert all string columns to unicode',
-        description='This setting makes the SQLAlchemy String column type '
-                    'equivalent to UnicodeString. Do not use this unless '
-                    'there is a good reason not to use standard '
-                    'UnicodeString columns',
-        required=False,
-        default=False)
-
     echo = zope.schema.Bool(
         title='Echo SQL statements',
         description='Enable logging statements for debugging.',
@@ -75,6 +108,233 @@ class IEngineDirective(zope.interface.Interface):
         description="Defaults to 30 in SQLAlchemy if not set",
         required=False)
 
+    poolclass = zope.schema.Choice(
+        title="Pool class",
+        description="The name of a pool class in sqlalchemy.pool, "
+                    "e.g. 'NullPool'. The dialect picks one by default.",
+        values=sorted(POOL_CLASSES),
+        required=False)
+
+    pool_pre_ping = zope.schema.Bool(
+        title="Test connections on checkout",
+        description="Replaces connections that were closed by the "
+                    "database server before they are used.",
+        required=False)
+
+    pool_use_lifo = zope.schema.Bool(
+        title="Check out the most recently used connection",
+        description="Lets surplus connections time out on the server "
+                    "side when the load goes down.",
+        required=False)
+
+    query_cache_size = zope.schema.Int(
+        title="Size of the compiled statement cache",
+        description="Defaults to 500 in SQLAlchemy; 0 disables it.",
+        required=False,
+        min=0)
+
+    isolation_level = zope.schema.TextLine(
+        title="Transaction isolation level",
+        description="e.g. 'READ COMMITTED' or 'SERIALIZABLE'.",
+        required=False)
+
+    executemany_mode = zope.schema.TextLine(
+        title="executemany mode of the dialect",
+        description="e.g. 'values_plus_batch' for psycopg2.",
+        required=False)
+
+    connect_args = _optionTokens(
+        title="Arguments for the DBAPI connect function",
+        description="key=value pairs separated by spaces. Dotted keys "
+                    "make nested dictionaries, e.g. 'ssl.ca=/ca.pem'. "
+                    "Values are strings unless the key ends with :int, "
+                    ":float, :bool or :none, e.g. 'timeout:int=10'.")
+
+    options = _optionTokens(
+        title="Other arguments for create_engine",
+        description="key=value pairs separated by spaces, for arguments "
+                    "the directive has no attribute for. Typed as for "
+                    "connect_args.")
+
+    instrument = zope.schema.Bool(
+        title="Collect connection pool statistics",
+        description="See z3c.saconfig.stats.",
+        required=False,
+        default=False)
+
+
+class IEngineDirective(IBaseEngineDirective):
+    """Registers a database engine factory."""
+
+    convert_unicode = zope.schema.Bool(
+        title='Convert all string columns to unicode',
+        description='This setting makes the SQLAlchemy String column type '
+                    'equivalent to UnicodeString. Do not use this unless '
+                    'there is a good reason not to use standard '
+                    'UnicodeString columns',
+        required=False,
+        default=False)
+
+    # Warm-up
+
+    warmup = zope.schema.Bool(
+        title="Warm up the engine",
+        description="Create the engine in a background thread once "
+                    "configuration is done, instead of on first use.",
+        required=False,
+        default=False)
+
+    prefill = zope.schema.Int(
+        title="Number of connections to open when warming up",
+        description="Implies warmup. No more connections than the "
+                    "pool size are opened.",
+        required=False,
+        default=0,
+        min=0)
+
+    # Read replicas
+
+    replicas = zope.configuration.fields.Tokens(
+        title="Replica database URLs",
+        description="If given, sessions send read-only statements to "
+                    "these databases and everything else to ``url``.",
+        value_type=zope.schema.URI(),
+        required=False)
+
+    replica_policy = zope.schema.Choice(
+        title="Replica selection policy",
+        description="'round-robin' or 'least-checked-out'.",
+        values=REPLICA_POLICIES,
+        required=False,
+        default=ROUND_ROBIN)
+
+    # Tenants
+
+    tenant = zope.schema.Bool(
+        title="Share the engine between tenants",
+        description="Tenant engines with the same configuration share "
+                    "one engine and pool. See TenantScopedSession.",
+        required=False,
+        default=False)
+
+    schema = zope.schema.TextLine(
+        title="Schema of the tenant",
+        description="Tables without a schema are looked up in this "
+                    "schema. Implies tenant.",
+        required=False)
+
+    # Failover
+
+    standbys = zope.configuration.fields.Tokens(
+        title="Standby database URLs",
+        description="If given, the engine fails over to the first of "
+                    "these that is available when ``url`` is not.",
+        value_type=zope.schema.URI(),
+        required=False)
+
+    failure_threshold = zope.schema.Int(
+        title="Connect failures before failing over",
+        description="Consecutive failures to connect that open the "
+                    "circuit breaker.",
+        required=False,
+        default=3,
+        min=1)
+
+    probe_interval = zope.schema.Float(
+        title="Seconds between database probes",
+        required=False,
+        default=5.0,
+        min=0.0)
+
+    # Reloading
+
+    watch = zope.configuration.fields.Path(
+        title="Engine configuration file to watch",
+        description="A JSON object with the url and keyword arguments "
+                    "for create_engine. The engine is reconfigured when "
+                    "it changes. Not for tenant engines. See "
+                    "z3c.saconfig.reload.",
+        required=False)
+
+    watch_interval = zope.schema.Float(
+        title="Seconds between checks of the watched file",
+        required=False,
+        default=5.0,
+        min=0.1)
+
+
+class IAsyncEngineDirective(IBaseEngineDirective):
+    """Registers an asyncio database engine factory."""
+
+
+class IEngineCacheDirective(zope.interface.Interface):
+    """Bounds the engines kept by all engine factories."""
+
+    maxsize = zope.schema.Int(
+        title="Maximum number of engines",
+        description="The least recently used engines are disposed "
+                    "beyond this.",
+        required=False,
+        min=1)
+
+    idle_ttl = zope.schema.Float(
+        title="Idle time to live",
+        description="Engines that were not used for this many seconds "
+                    "are disposed.",
+        required=False,
+        min=0.0)
+
+
+class ISharedPoolStatsDirective(zope.interface.Interface):
+    """Writes pool statistics to a file shared by all processes."""
+
+    path = zope.configuration.fields.Path(
+        title="Statistics file",
+        description="Memory-mapped file the workers write their pool "
+                    "statistics to. See z3c.saconfig.sharedstats.",
+        required=True)
+
+    engines = zope.configuration.fields.Tokens(
+        title="Engine names",
+        description="All instrumented engines by default.",
+        value_type=zope.schema.TextLine(),
+        required=False)
+
+    slots = zope.schema.Int(
+        title="Number of slots",
+        description="Each engine of each process takes a slot.",
+        required=False,
+        default=256,
+        min=1)
+
+
+class IConnectionBudgetDirective(zope.interface.Interface):
+    """Limits the connections checked out of all engines together."""
+
+    limit = zope.schema.Int(
+        title="Maximum number of connections",
+        description="Checkouts of engines created by engine factories "
+                    "wait beyond this. See z3c.saconfig.budget.",
+        required=True,
+        min=1)
+
+    timeout = zope.schema.Float(
+        title="Seconds to wait for a connection",
+        description="By default checkouts wait as long as it takes.",
+        required=False,
+        min=0.0)
+
+
+class ISessionCleanupDirective(zope.interface.Interface):
+    """Closes the sessions of all scoped sessions when idle."""
+
+    idle_ttl = zope.schema.Float(
+        title="Idle time to live",
+        description="Sessions that were not used for this many seconds "
+                    "are closed by their thread.",
+        required=False,
+        min=0.0)
+
 
 class ISessionDirective(zope.interface.Interface):
     """Registers a database scoped session"""
@@ -103,37 +363,217 @@ class ISessionDirective(zope.interface.Interface):
         required=False,
         default="z3c.saconfig.utility.GloballyScopedSession")
 
+    profile = zope.schema.Bool(
+        title="Time the statements of the sessions",
+        description="See z3c.saconfig.profiling.",
+        required=False,
+        default=False)
+
+    slow_threshold = zope.schema.Float(
+        title="Slow statement threshold",
+        description="Statements taking longer than this many seconds are "
+                    "logged with their parameters. Implies profile.",
+        required=False,
+        min=0.0)
+
+    cache_size = zope.schema.Int(
+        title="Number of objects to cache",
+        description="Keep objects loaded by the sessions in a process "
+                    "wide cache for Session.get. See z3c.saconfig.cache.",
+        required=False,
+        min=1)
+
+    cache_ttl = zope.schema.Float(
+        title="Seconds to cache objects",
+        description="60 by default. Implies a cache of 1000 objects if "
+                    "cache_size is not set.",
+        required=False,
+        min=0.0)
+
+    share_connection = zope.schema.Bool(
+        title="Share connections with other sessions",
+        description="Sessions with this option use one connection per "
+                    "engine within a transaction. See z3c.saconfig.shared.",
+        required=False,
+        default=False)
+
+    deadlines = zope.schema.Bool(
+        title="Cancel statements at the request deadline",
+        description="Statements still running at the deadline set with "
+                    "z3c.saconfig.deadline.set_deadline are cancelled. "
+                    "Can't be combined with share_connection.",
+        required=False,
+        default=False)
+
+    scope = zope.schema.Choice(
+        title="Unit of concurrency with its own session",
+        description="thread (the default), greenlet or context. See "
+                    "z3c.saconfig.scopes.",
+        required=False,
+        values=('thread', 'greenlet', 'context'))
+
+
+class IAsyncSessionDirective(zope.interface.Interface):
+    """Registers an asyncio scoped session"""
+
+    name = zope.schema.Text(
+        title="Scoped session name",
+        description="Empty if this is the default session.",
+        required=False,
+        default="")
+
+    engine = zope.schema.Text(
+        title="Engine name",
+        description="Empty if this is to use the default asyncio engine.",
+        required=False,
+        default="")
+
+    factory = zope.schema.DottedName(
+        title='Scoped Session utility factory',
+        description='AsyncScopedSession by default',
+        required=False,
+        default="z3c.saconfig.utility.AsyncScopedSession")
+
 
 def engine(_context, url, name="", convert_unicode=False,
-           echo=None, setup=None, twophase=False,
-           pool_size=None, max_overflow=None, pool_recycle=None,
-           pool_timeout=None):
+           setup=None, twophase=False, replicas=None,
+           replica_policy=ROUND_ROBIN, warmup=False, prefill=0,
+           instrument=False, tenant=False, schema=None, standbys=None,
+           failure_threshold=3, probe_interval=5.0, watch=None,
+           watch_interval=5.0, **options):
 
     if convert_unicode:  # pragma: no cover
         warnings.warn(
             '`convert_unicode` is no longer suported by SQLAlchemy, so it is'
             ' ignored here.', DeprecationWarning)
 
+    kwargs = _engine_kwargs(**options)
+
+    if len([mode for mode in (replicas, tenant or schema, standbys)
+            if mode]) > 1:
+        raise ConfigurationError(
+            "Only one of replicas, tenant and standbys can be used")
+    if watch and (tenant or schema):
+        raise ConfigurationError(
+            "The engines of tenants are shared and can't be watched")
+
+    if replicas:
+        factory = RoutingEngineFactory(
+            url, replicas=replicas, policy=replica_policy,
+            instrument=instrument, **kwargs)
+    elif tenant or schema:
+        factory = TenantEngineFactory(
+            url, schema=schema, instrument=instrument, **kwargs)
+    elif standbys:
+        factory = FailoverEngineFactory(
+            [url] + list(standbys), failure_threshold=failure_threshold,
+            probe_interval=probe_interval, instrument=instrument, **kwargs)
+    else:
+        factory = EngineFactory(url, instrument=instrument, **kwargs)
+
+    _register_engine(_context, factory, IEngineFactory, name, setup)
+
+    if warmup or prefill:
+        # after the setup callback, which runs with order 9999
+        _context.action(
+            discriminator=None,
+            callable=factory.warmup,
+            args=(prefill, True),
+            order=10000)
+
+    if watch:
+        _context.action(
+            discriminator=('z3c.saconfig.watch', watch),
+            callable=reload.watch,
+            args=(factory, watch, watch_interval, prefill),
+            order=10000)
+
+
+def asyncEngine(_context, url, name="", setup=None, instrument=False,
+                **options):
+    kwargs = _engine_kwargs(**options)
+    factory = AsyncEngineFactory(url, instrument=instrument, **kwargs)
+    _register_engine(_context, factory, IAsyncEngineFactory, name, setup)
+
+
+def _engine_kwargs(echo=None, poolclass=None, connect_args=None,
+                   options=None, **settings):
     kwargs = {
         'echo': echo,
     }
 
     # Only add these if they're actually set, since we want to let SQLAlchemy
     # control the defaults
-    if pool_size is not None:
-        kwargs['pool_size'] = pool_size
-    if max_overflow is not None:
-        kwargs['max_overflow'] = max_overflow
-    if pool_recycle is not None:
-        kwargs['pool_recycle'] = pool_recycle
-    if pool_timeout is not None:
-        kwargs['pool_timeout'] = pool_timeout
-
-    factory = EngineFactory(url, **kwargs)
-
+    for key, value in settings.items():
+        if value is not None:
+            kwargs[key] = value
+    if poolclass is not None:
+        kwargs['poolclass'] = POOL_CLASSES[poolclass]
+    if connect_args:
+        kwargs['connect_args'] = _parse_options(connect_args)
+    if options:
+        for key, value in _parse_options(options).items():
+            kwargs.setdefault(key, value)
+    return kwargs
+
+
+def _parse_options(tokens):
+    """Turn key=value tokens into a dictionary.
+
+    Dotted keys make nested dictionaries. Values are strings, unless the
+    key ends with the name of a type in _CONVERTERS, as in
+    ``timeout:int=10``.
+    """
+    result = {}
+    for token in tokens:
+        key, value = token.split('=', 1)
+        key, _, type_ = key.strip().partition(':')
+        if type_:
+            value = _convert(key, type_, value)
+        path = key.split('.')
+        target = result
+        for part in path[:-1]:
+            target = target.setdefault(part, {})
+            if not isinstance(target, dict):
+                raise ConfigurationError(
+                    "Option %r conflicts with an earlier one" % key)
+        target[path[-1]] = value
+    return result
+
+
+def _bool(value):
+    try:
+        return {'true': True, 'false': False}[value.lower()]
+    except KeyError:
+        raise ValueError(value) from None
+
+
+def _none(value):
+    if value:
+        raise ValueError(value)
+    return None
+
+
+_CONVERTERS = {
+    'int': int,
+    'float': float,
+    'bool': _bool,
+    'none': _none,
+}
+
+
+def _convert(key, type_, value):
+    try:
+        return _CONVERTERS[type_](value)
+    except (KeyError, ValueError):
+        raise ConfigurationError(
+            "Option %r: %r is not a valid %s" % (key, value, type_))
+
+
+def _register_engine(_context, factory, provides, name, setup):
     zope.component.zcml.utility(
         _context,
-        provides=IEngineFactory,
+        provides=provides,
         component=factory,
         permission=PublicPermission,
         name=name)
@@ -147,19 +587,69 @@ def engine(_context, url, name="", convert_unicode=False,
         else:
             callback = resolve(setup, package=_context.package.__name__)
         _context.action(
-            discriminator=(IEngineFactory, name),
+            discriminator=(provides, name),
             callable=callback,
             args=(factory(), ),
             order=9999)
 
 
+def engineCache(_context, maxsize=None, idle_ttl=None):
+    _context.action(
+        discriminator=('z3c.saconfig.engineCache', ),
+        callable=configure_engine_cache,
+        args=(maxsize, idle_ttl))
+
+
+def sharedPoolStats(_context, path, engines=None, slots=256):
+    # after the engine factories are registered
+    _context.action(
+        discriminator=('z3c.saconfig.sharedPoolStats', path),
+        callable=sharedstats.export_pool_stats,
+        args=(path, engines, slots),
+        order=10000)
+
+
+def connectionBudget(_context, limit, timeout=None):
+    _context.action(
+        discriminator=('z3c.saconfig.connectionBudget', ),
+        callable=configure_connection_budget,
+        args=(limit, timeout))
+
+
+def sessionCleanup(_context, idle_ttl=None):
+    _context.action(
+        discriminator=('z3c.saconfig.sessionCleanup', ),
+        callable=configure_session_cleanup,
+        args=(idle_ttl, ))
+
+
 def session(_context, name="", engine="", twophase=False,
-            factory="z3c.saconfig.utility.GloballyScopedSession"):
+            factory="z3c.saconfig.utility.GloballyScopedSession",
+            profile=False, slow_threshold=None, cache_size=None,
+            cache_ttl=None, share_connection=False, deadlines=False,
+            scope=None):
     if _context.package is None:
         ScopedSession = resolve(factory)
     else:
         ScopedSession = resolve(factory, package=_context.package.__name__)
-    scoped_session = ScopedSession(engine=engine, twophase=twophase)
+    # only pass options that are used, custom factories may not take them
+    options = {}
+    if profile:
+        options['profile'] = profile
+    if slow_threshold is not None:
+        options['slow_threshold'] = slow_threshold
+    if cache_size is not None:
+        options['cache_size'] = cache_size
+    if cache_ttl is not None:
+        options['cache_ttl'] = cache_ttl
+    if share_connection:
+        options['share_connection'] = share_connection
+    if deadlines:
+        options['deadlines'] = deadlines
+    if scope is not None:
+        options['scope'] = scope
+    scoped_session = ScopedSession(engine=engine, twophase=twophase,
+                                   **options)
 
     zope.component.zcml.utility(
         _context,
@@ -167,3 +657,19 @@ def session(_context, name="", engine="", twophase=False,
         component=scoped_session,
         permission=PublicPermission,
         name=name)
+
+
+def asyncSession(_context, name="", engine="",
+                 factory="z3c.saconfig.utility.AsyncScopedSession"):
+    if _context.package is None:
+        ScopedSession = resolve(factory)
+    else:
+        ScopedSession = resolve(factory, package=_context.package.__name__)
+    scoped_session = ScopedSession(engine=engine)
+
+    zope.component.zcml.utility(
+        _context,
+        provides=IAsyncScopedSession,
+        component=scoped_session,
+        permission=PublicPermission,
+        name=name)